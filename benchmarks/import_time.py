@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Measures how long importing each core plug-in takes and which heavy modules it loads.
+#
+# OSPy imports every plug-in at startup, also the disabled ones, so importing
+# should not load modules that are only needed to send mail or run programs.
+# Every plug-in is imported in a fresh process against the stand-in modules in
+# ./stand_in, from compiled bytecode like OSPy does, and the fastest of
+# several imports counts. With --check the script fails if a plug-in loads one
+# of the HEAVY_MODULES or takes longer than the budget. Timings depend on the
+# machine, so compare against a baseline saved on the same machine before a
+# change:
+#
+#   python benchmarks/import_time.py --save /tmp/import_baseline.json
+#   python benchmarks/import_time.py --check --baseline /tmp/import_baseline.json
+
+import json
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STAND_IN_DIR = os.path.join(BENCHMARK_DIR, 'stand_in')
+PLUGINS_DIR = os.path.join(BENCHMARK_DIR, '..', 'plugins')
+
+# Modules that are only needed when a plug-in actually does its work:
+HEAVY_MODULES = ['smtplib', 'email.mime.multipart', 'email.mime.text', 'email.encoders', 'subprocess', 'platform',
+                 'uuid']
+
+# Modules that OSPy itself has imported before it loads the plug-ins:
+CORE_MODULES = ['datetime', 'json', 'logging', 'threading', 'traceback']
+
+BUDGET_MS = 20.0   # Milliseconds per plug-in, measured on a desktop; a Pi Zero is about 10 times slower
+REPEAT = 10        # Imports per plug-in, the fastest one counts
+TOLERANCE = 1.5    # Allowed slowdown against the baseline
+SLACK_MS = 2.0     # Allowed slowdown in milliseconds, for plug-ins that import very fast
+
+
+def measure(name):
+    """Imports one plug-in in this process and returns the milliseconds it took and the heavy modules it loaded."""
+    sys.path.insert(0, STAND_IN_DIR)
+    ospy_modules = ['ospy.' + filename[:-3] for filename in sorted(os.listdir(os.path.join(STAND_IN_DIR, 'ospy')))
+                    if filename.endswith('.py') and filename != '__init__.py']
+    for module in CORE_MODULES + ['ospy', 'web', 'plugins'] + ospy_modules:
+        __import__(module)
+
+    before = set(sys.modules)
+    start = time.perf_counter()
+    __import__('plugins.' + name)
+    elapsed = time.perf_counter() - start
+    return {
+        'import_ms': round(1000 * elapsed, 2),
+        'heavy_modules': sorted(module for module in HEAVY_MODULES if module in set(sys.modules) - before)
+    }
+
+
+def plugin_names():
+    return sorted(name for name in os.listdir(PLUGINS_DIR)
+                  if os.path.isfile(os.path.join(PLUGINS_DIR, name, '__init__.py')))
+
+
+def main():
+    import argparse
+    import shutil
+    import subprocess
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='Measure the import time of the core plug-ins.')
+    parser.add_argument('--plugin', action='append', choices=plugin_names(), help='plug-in to measure')
+    parser.add_argument('--budget', type=float, default=BUDGET_MS, help='milliseconds allowed per plug-in')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='imports per plug-in, the fastest one counts')
+    parser.add_argument('--baseline', help='JSON output of an earlier run to compare with')
+    parser.add_argument('--save', help='also write the JSON output to this file, to use as baseline later')
+    parser.add_argument('--check', action='store_true', help='exit with an error if a plug-in is over budget')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+
+    # Compiled bytecode goes to a separate folder, so the source tree stays clean:
+    cache_dir = tempfile.mkdtemp(prefix='ospy-import-time-')
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=cache_dir)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    results = {}
+    failures = []
+    try:
+        for name in args.plugin or plugin_names():
+            command = [sys.executable, os.path.abspath(__file__), '--single', name]
+            subprocess.check_output(command, env=env)  # Compiles the bytecode
+            runs = []
+            for _ in range(args.repeat):
+                output = subprocess.check_output(command, env=env)
+                runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+            result = min(runs, key=lambda run: run['import_ms'])
+            results[name] = result
+            if result['heavy_modules']:
+                failures.append('%s loads %s' % (name, ', '.join(result['heavy_modules'])))
+            if name in baseline:
+                limit = baseline[name]['import_ms'] * TOLERANCE + SLACK_MS
+                if result['import_ms'] > limit:
+                    failures.append('%s takes %.1f ms (baseline %.1f ms)' %
+                                    (name, result['import_ms'], baseline[name]['import_ms']))
+            elif result['import_ms'] > args.budget:
+                failures.append('%s takes %.1f ms (budget %.1f ms)' % (name, result['import_ms'], args.budget))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    output = json.dumps({'budget_ms': args.budget, 'results': results}, indent=2, sort_keys=True)
+    print(output)
+    if args.save:
+        with open(args.save, 'w') as fh:
+            fh.write(output + '\n')
+    if args.check and failures:
+        sys.exit('Import budget exceeded:\n  ' + '\n  '.join(failures))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--single']:  # Keep this process free of anything the plug-in could import
+        print(json.dumps(measure(sys.argv[2])))
+    else:
+        main()
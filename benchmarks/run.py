@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Measures what the background loops of the core plug-ins cost, without OSPy or a Raspberry Pi.
+#
+# Every plug-in runs in its own process against the stand-in modules in ./stand_in.
+# The results are written as JSON, for example:
+#
+#   python benchmarks/run.py --seconds 30 > results.json
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Event
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+STAND_IN_DIR = os.path.join(BENCHMARK_DIR, 'stand_in')
+
+# The loop object and the options that are enabled for each plug-in:
+PLUGINS = OrderedDict([
+    ('weather_based_water_level', {
+        'loop': 'checker',
+        'options': 'plugin_options',
+        'settings': {'enabled': True, 'days_history': 20, 'days_forecast': 7}}),
+    ('weather_based_rain_delay', {
+        'loop': 'checker',
+        'options': 'plugin_options',
+        'settings': {'enabled': True}}),
+    ('monthly_water_level', {
+        'loop': 'checker',
+        'options': 'plugin_options',
+        'settings': {}}),
+    ('email_notifications', {
+        'loop': 'email_sender',
+        'options': 'email_options',
+        'settings': {'emlrain': True, 'emlrun': True}}),
+    ('system_update', {
+        'loop': 'checker',
+        'options': 'plugin_options',
+        'settings': {}}),
+])
+
+WARM_UP = 1.0           # Seconds to let a plug-in start before measuring
+LATENCY_TIMEOUT = 30.0  # Seconds to wait for a loop to finish an iteration after update()
+
+
+def _git_sandbox(root):
+    """Creates a repository with a local bare upstream in root for the System Update plug-in and returns its path."""
+    remote = os.path.join(root, 'remote.git')
+    work = os.path.join(root, 'work')
+
+    def git(*args, **kwargs):
+        subprocess.check_output(('git',) + args, stderr=subprocess.STDOUT, **kwargs)
+
+    git('init', '--bare', '-q', remote)
+    git('clone', '-q', remote, work)
+    git('-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost',
+        'commit', '-q', '--allow-empty', '-m', 'Benchmark', cwd=work)
+    git('push', '-q', 'origin', 'HEAD', cwd=work)
+    branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=work).decode('utf-8').strip()
+    git('branch', '-q', '--set-upstream-to', 'origin/' + branch, cwd=work)
+    return work
+
+
+def _redirect_data(module, data_dir):
+    """Points the files a plug-in keeps in its data folder at data_dir, so the real history is left alone."""
+    from plugins.core_services import weather_store
+    from plugins.core_services.weather_store import WeatherStore
+    for owner in [weather_store, module]:
+        for value in list(vars(owner).values()):
+            if isinstance(value, WeatherStore):
+                value.close()
+                value.path = os.path.join(data_dir, os.path.basename(value.path))
+    if hasattr(module, 'SPOOL_DIR'):
+        module.SPOOL_DIR = os.path.join(data_dir, 'spool')
+
+
+def _usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return time.process_time(), usage.ru_nvcsw + usage.ru_nivcsw
+
+
+def _watch_iterations(loop):
+    """Returns an Event that is set whenever the loop records the end of an iteration in its LoopMetrics."""
+    finished = Event()
+
+    def recorder(record):
+        def wrapper(start):
+            record(start)
+            finished.set()
+        return wrapper
+
+    loop._metrics.success = recorder(loop._metrics.success)
+    loop._metrics.failure = recorder(loop._metrics.failure)
+    return finished
+
+
+def _summary(values, scale=1000):
+    return OrderedDict([
+        ('mean', round(scale * sum(values) / len(values), 2) if values else None),
+        ('max', round(scale * max(values), 2) if values else None)])
+
+
+def measure(name, seconds, samples):
+    """Runs one plug-in in this process and returns its measurements."""
+    sys.path.insert(0, STAND_IN_DIR)
+    sandbox = tempfile.mkdtemp(prefix='ospy-benchmark-')
+    try:
+        if name == 'system_update':
+            os.chdir(_git_sandbox(sandbox))
+
+        import ospy
+        config = PLUGINS[name]
+        module = importlib.import_module('plugins.' + name)
+        _redirect_data(module, os.path.join(sandbox, 'data'))
+        getattr(module, config['options']).update(config['settings'])
+        module.start()
+        loop = getattr(module, config['loop'])
+        finished = _watch_iterations(loop)
+
+        time.sleep(WARM_UP)
+        loop.update()  # Skip initial delays
+        time.sleep(WARM_UP)
+
+        # Idle cost:
+        start_time = time.monotonic()
+        start_cpu, start_switches = _usage()
+        time.sleep(seconds)
+        end_cpu, end_switches = _usage()
+        elapsed = time.monotonic() - start_time
+
+        # A full iteration after update(), CPU time includes all threads of the process:
+        reactions = []
+        latencies = []
+        cpu_times = []
+        for _ in range(samples):
+            time.sleep(0.2)
+            ospy.activity.clear()
+            finished.clear()
+            update_time = time.monotonic()
+            update_cpu = time.process_time()
+            loop.update()
+            if ospy.activity.wait(LATENCY_TIMEOUT):
+                reactions.append(time.monotonic() - update_time)
+            if finished.wait(LATENCY_TIMEOUT):
+                latencies.append(time.monotonic() - update_time)
+                cpu_times.append(time.process_time() - update_cpu)
+
+        module.stop()
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+    return OrderedDict([
+        ('cpu_seconds', round(end_cpu - start_cpu, 4)),
+        ('cpu_percent', round(100.0 * (end_cpu - start_cpu) / elapsed, 3)),
+        # One context switch is the sleep of this thread itself:
+        ('wakeups_per_hour', int(round(max(0, end_switches - start_switches - 1) * 3600.0 / elapsed))),
+        ('peak_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        ('update_latency_ms', OrderedDict([
+            ('samples', len(latencies)),
+            ('missed', samples - len(latencies))] + list(_summary(latencies).items()) + [
+            ('first_call_mean', _summary(reactions)['mean'])])),
+        ('iteration_cpu_ms', _summary(cpu_times))
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the background loops of the core plug-ins.')
+    parser.add_argument('--seconds', type=float, default=10.0, help='idle time measured per plug-in')
+    parser.add_argument('--samples', type=int, default=10, help='number of update() latency samples')
+    parser.add_argument('--plugin', action='append', choices=list(PLUGINS.keys()), help='plug-in to measure')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(measure(args.plugin[0], args.seconds, args.samples)))
+        return
+
+    results = OrderedDict()
+    for name in args.plugin or PLUGINS.keys():
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--single', '--plugin', name,
+                                          '--seconds', str(args.seconds), '--samples', str(args.samples)])
+        results[name] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    print(json.dumps(OrderedDict([
+        ('python', platform.python_version()),
+        ('machine', platform.machine()),
+        ('seconds', args.seconds),
+        ('results', results)
+    ]), indent=2))
+
+
+if __name__ == '__main__':
+    main()
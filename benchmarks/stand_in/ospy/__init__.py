@@ -0,0 +1,10 @@
+# Stand-in for the OSPy package, just enough to load and run the core plug-ins offline.
+
+from threading import Event
+
+# Set by every call into the stand-in modules, used to see when a plug-in loop reacts.
+activity = Event()
+
+
+def touch():
+    activity.set()
@@ -0,0 +1,43 @@
+import datetime
+
+
+def datetime_string(timestamp=None):
+    return (timestamp or datetime.datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_input(qdict, key, default=None, cast=None):
+    if key in qdict:
+        return cast(qdict[key]) if cast is not None else qdict[key]
+    return default
+
+
+def stop_onrain():
+    pass
+
+
+def restart(wait=1, block=False):
+    pass
+
+
+def get_meminfo():
+    return {'MemTotal': '512 MB', 'MemFree': '256 MB'}
+
+
+def get_netdevs():
+    return {'eth0': {'rx': '1.0', 'tx': '1.0'}}
+
+
+def uptime():
+    return '1 day'
+
+
+def get_cpu_temp(unit=None):
+    return '40.0'
+
+
+def get_mac():
+    return '00:00:00:00:00:00'
+
+
+def get_rpi_revision():
+    return 2
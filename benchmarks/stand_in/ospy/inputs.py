@@ -0,0 +1,12 @@
+from ospy import touch
+
+
+class _Inputs(object):
+    rain = False
+
+    def rain_sensed(self):
+        touch()
+        return self.rain
+
+
+inputs = _Inputs()
@@ -0,0 +1,62 @@
+import datetime
+import os
+import tempfile
+
+from ospy import touch
+
+EVENT_FILE = os.path.join(tempfile.gettempdir(), 'ospy-benchmark-events.log')
+
+
+class _Log(object):
+    def __init__(self):
+        self._events = {}
+        self._log = {'Run': []}  # Entries like OSPy keeps them, the run is in 'data'
+
+    def clear(self, module):
+        touch()
+        self._events[module] = []
+
+    def _event(self, module, level, message):
+        touch()
+        self._events.setdefault(module, []).append(message)
+
+    def debug(self, module, message):
+        self._event(module, 'DEBUG', message)
+
+    def info(self, module, message):
+        self._event(module, 'INFO', message)
+
+    def warning(self, module, message):
+        self._event(module, 'WARNING', message)
+
+    def error(self, module, message):
+        self._event(module, 'ERROR', message)
+
+    def events(self, module):
+        return list(self._events.get(module, []))
+
+    def finished_runs(self):
+        touch()
+        return [entry['data'].copy() for entry in self._log['Run'] if not entry['data']['active']]
+
+    def active_runs(self):
+        touch()
+        return [entry['data'].copy() for entry in self._log['Run'] if entry['data']['active']]
+
+    def add_run(self, station, minutes=1, active=False):
+        """Adds a run, used to generate work for the plug-ins. Returns the run, set 'active' to finish it."""
+        end = datetime.datetime.now()
+        run = {
+            'start': end - datetime.timedelta(minutes=minutes),
+            'end': end,
+            'station': station,
+            'program': 1,
+            'program_name': 'Benchmark',
+            'manual': False,
+            'blocked': False,
+            'active': active}
+        self._log['Run'].append({'time': run['start'], 'data': run})
+        return run
+
+
+log = _Log()
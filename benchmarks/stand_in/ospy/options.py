@@ -0,0 +1,18 @@
+from ospy import touch
+
+
+class _Options(dict):
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setitem__(self, key, value):
+        touch()
+        dict.__setitem__(self, key, value)
+
+
+options = _Options(name='OSPy', temp_unit='C', debug_log=True)
+level_adjustments = _Options()
+rain_blocks = _Options()
@@ -0,0 +1,5 @@
+class _Outputs(object):
+    relay_output = False
+
+
+outputs = _Outputs()
@@ -0,0 +1,6 @@
+from ospy import touch
+
+
+def predicted_schedule(start_time, end_time):
+    touch()
+    return []
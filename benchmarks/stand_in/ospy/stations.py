@@ -0,0 +1,34 @@
+from ospy import touch
+
+STATION_COUNT = 16
+
+
+class _Station(object):
+    def __init__(self, index):
+        self.index = index
+        self.name = 'Station %02d' % (index + 1)
+        self.enabled = True
+        self.active = False
+        self.remaining_seconds = 0
+
+
+class _Stations(object):
+    def __init__(self):
+        self._stations = [_Station(index) for index in range(STATION_COUNT)]
+
+    def get(self, index=None):
+        touch()
+        return list(self._stations) if index is None else self._stations[index]
+
+    def enabled_stations(self):
+        touch()
+        return [station for station in self._stations if station.enabled]
+
+    def count(self):
+        return len(self._stations)
+
+    def __iter__(self):
+        return iter(self._stations)
+
+
+stations = _Stations()
@@ -0,0 +1,3 @@
+ver_str = '0.0.0'
+ver_date = '2000-01-01'
+revision = 0
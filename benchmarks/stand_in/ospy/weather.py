@@ -0,0 +1,44 @@
+import random
+import time
+
+from ospy import touch
+
+
+class _Weather(object):
+    """Returns plausible, repeatable weather for any date."""
+
+    def __init__(self):
+        self._callbacks = []
+
+    def add_callback(self, function):
+        self._callbacks.append(function)
+
+    def remove_callback(self, function):
+        if function in self._callbacks:
+            self._callbacks.remove(function)
+
+    def notify(self):
+        """Calls the callbacks like OSPy does after receiving new weather data."""
+        for function in list(self._callbacks):
+            function()
+
+    def get_hourly_data(self, check_date):
+        touch()
+        rnd = random.Random(check_date.toordinal())
+        midnight = time.mktime(check_date.timetuple())
+        return [{'time': int(midnight) + 3600 * hour,
+                 'temperature': rnd.uniform(5, 30),
+                 'windSpeed': rnd.uniform(0, 10),
+                 'humidity': rnd.uniform(30, 90),
+                 'precipitation': max(0.0, rnd.uniform(-2, 1))} for hour in range(24)]
+
+    def get_rain(self, check_date):
+        touch()
+        return sum(hour['precipitation'] for hour in self.get_hourly_data(check_date))
+
+    def get_current_data(self):
+        touch()
+        return {'temperature': 12.0, 'windSpeed': 3.0, 'humidity': 60.0, 'precipitation': 0.0}
+
+
+weather = _Weather()
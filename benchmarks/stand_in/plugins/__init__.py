@@ -0,0 +1,28 @@
+# Stand-in for the plugins package of OSPy that loads the plug-ins of this repository.
+
+import os
+
+__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'plugins'))
+
+
+class PluginOptions(dict):
+    def __init__(self, plugin, defaults):
+        dict.__init__(self, defaults)
+        self._plugin = plugin
+
+    def web_update(self, qdict, skipped=None):
+        for key, old_value in list(self.items()):
+            if skipped is not None and key in skipped:
+                continue
+            if isinstance(old_value, bool):
+                self[key] = qdict.get(key, 'off') == 'on'
+            elif key in qdict:
+                if isinstance(old_value, list):
+                    value = qdict[key]
+                    self[key] = [type(old_value[0])(x) for x in value] if old_value else list(value)
+                else:
+                    self[key] = type(old_value)(qdict[key])
+
+
+def plugin_url(page, prefix='/plugins/', absolute=False):
+    return prefix + str(page)
@@ -0,0 +1,29 @@
+# Stand-in for web.py, just enough to import the core plug-ins.
+
+
+class Storage(dict):
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+class seeother(Exception):
+    def __init__(self, url, absolute=False):
+        Exception.__init__(self, url)
+
+
+class notmodified(Exception):
+    pass
+
+
+ctx = Storage(env={})
+
+
+def input(**defaults):
+    return Storage(defaults)
+
+
+def header(key, value):
+    pass
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# this plugin provides the services shared by the other core plugins
+
+import web
+from ospy.webpages import ProtectedPage
+from plugins.core_services.metrics import metrics
+from plugins.core_services.options import settings_cache, flush_options
+from plugins.core_services.scheduler import scheduler
+
+NAME = 'Core Services'
+LINK = 'status_page'
+
+
+################################################################################
+# Helper functions:                                                            #
+################################################################################
+def start():
+    pass
+
+
+def stop():
+    flush_options()
+
+
+################################################################################
+# Web pages:                                                                   #
+################################################################################
+class status_page(ProtectedPage):
+    """Load an html page with the state of the shared services."""
+
+    def GET(self):
+        return self.plugin_render.core_services(scheduler.sleepers(), scheduler.wakeups)
+
+
+class metrics_text(ProtectedPage):
+    """Returns the runtime metrics of the core plugins in the Prometheus text format."""
+
+    def GET(self):
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.render()
+
+
+class settings_json(ProtectedPage):
+    """Returns the settings of all core plugins in JSON format, with passwords redacted."""
+
+    def GET(self):
+        etag, body = settings_cache.get()
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Cache-Control', 'no-cache')
+        web.header('ETag', etag)
+        if etag in [tag.strip() for tag in web.ctx.env.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            raise web.notmodified()
+        web.header('Content-Type', 'application/json')
+        return body
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Status messages of the core plugins, formatted only when they are shown.
+
+import logging
+import time
+from collections import deque
+
+from ospy.log import log
+from ospy.options import options
+
+DEFAULT_CAPACITY = 100  # Messages kept per plugin
+
+
+class PluginLog(object):
+    """Keeps the last messages of a plugin as (time, level, format, args) records.
+
+    Messages are formatted when a page shows them, so a loop that logs every
+    cycle does not build strings nobody reads. The buffer has a fixed capacity,
+    the oldest messages are dropped first.
+
+    Warnings and errors are also passed on to the OSPy log right away, other
+    messages only when OSPy debug logging is enabled.
+    """
+
+    def __init__(self, plugin, capacity=DEFAULT_CAPACITY):
+        self.plugin = plugin
+        self._records = deque(maxlen=capacity)
+
+    def _add(self, level, msg, args):
+        if level == logging.DEBUG and not options.debug_log:
+            return
+        self._records.append((time.time(), level, msg, args))
+        if level >= logging.WARNING or options.debug_log:
+            forward = {logging.DEBUG: log.debug, logging.INFO: log.info, logging.WARNING: log.warning}.get(level, log.error)
+            forward(self.plugin, _format(msg, args))
+
+    def debug(self, msg, *args):
+        self._add(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self._add(logging.INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self._add(logging.WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self._add(logging.ERROR, msg, args)
+
+    def clear(self):
+        self._records.clear()
+        log.clear(self.plugin)
+
+    def records(self):
+        """Returns a copy of the (time, level, format, args) records, oldest first."""
+        return list(self._records)
+
+    def events(self):
+        """Returns the formatted messages, oldest first."""
+        return [_format(msg, args) for _, _, msg, args in self.records()]
+
+
+def _format(msg, args):
+    try:
+        return msg % args if args else msg
+    except (TypeError, ValueError):
+        return '%s %r' % (msg, args)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Runtime metrics of the core plug-ins in the Prometheus text format.
+
+import bisect
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# Upper bounds in seconds, from a fast loop iteration to a slow network call:
+DEFAULT_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 2.5, 10.0, 60.0)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra is not None else [])
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in items) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name + _format_labels(labels), self.value
+
+
+class Gauge(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name + _format_labels(labels), self.value
+
+
+class Histogram(object):
+    """Counts observations per bucket. All storage is allocated up front."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_since(self, start):
+        """Observes the seconds passed since start (a time.monotonic() value)."""
+        self.observe(time.monotonic() - start)
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield name + '_bucket' + _format_labels(labels, ('le', bound)), total
+        yield name + '_sum' + _format_labels(labels), self.sum
+        yield name + '_count' + _format_labels(labels), self.count
+
+
+class Registry(object):
+    """Keeps all metrics. Metrics are created once and updated without locking."""
+
+    _TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+    def __init__(self):
+        self._lock = Lock()
+        self._families = OrderedDict()
+
+    def _get(self, cls, name, description, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (cls, description, OrderedDict()))
+            if family[0] is not cls:
+                raise ValueError('Metric %s is already registered as a %s.' % (name, self._TYPES[family[0]]))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(*args)
+            return metric
+
+    def counter(self, name, description, **labels):
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name, description, **labels):
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, description, labels, buckets)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            families = [(name, cls, description, list(metrics.items()))
+                        for name, (cls, description, metrics) in self._families.items()]
+        for name, cls, description, metrics in families:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, self._TYPES[cls]))
+            for labels, metric in metrics:
+                for sample, value in metric.samples(name, labels):
+                    lines.append('%s %s' % (sample, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class LoopMetrics(object):
+    """The metrics every background loop of a plug-in records."""
+
+    def __init__(self, registry, plugin):
+        self.duration = registry.histogram('ospy_plugin_iteration_seconds',
+                                           'Duration of one iteration of the plug-in loop.', plugin=plugin)
+        self.exceptions = registry.counter('ospy_plugin_exceptions_total',
+                                           'Exceptions caught by the plug-in loop.', plugin=plugin)
+        self.last_success = registry.gauge('ospy_plugin_last_success_timestamp_seconds',
+                                           'Unix time of the last successful iteration.', plugin=plugin)
+
+    def success(self, start):
+        """Records a successful iteration that started at start (a time.monotonic() value)."""
+        self.duration.observe_since(start)
+        self.last_success.set(time.time())
+
+    def failure(self, start):
+        self.duration.observe_since(start)
+        self.exceptions.inc()
+
+
+metrics = Registry()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Plugin options that take part in the aggregate settings of the core plugins.
+
+import atexit
+import json
+import time
+import traceback
+from collections import OrderedDict
+from threading import Thread, Lock
+
+from ospy.options import options
+from plugins import PluginOptions
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
+
+REDACTED = '********'
+_MISSING = object()
+FLUSH_DELAY = 2.0       # Seconds without changes before changed options are written
+FLUSH_MAX_DELAY = 10.0  # Seconds a change waits at most while changes keep coming in
+RETRY_DELAY = 60.0      # Seconds before options that could not be written are tried again
+
+WRITER_NAME = 'Options writer'
+writer_log = PluginLog(WRITER_NAME)
+
+
+class SettingsCache(object):
+    """Keeps the serialized settings of all managed plugins until one of them changes."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._options = OrderedDict()
+        self._generation = 0
+        self._cached = (None, None, None)
+
+    def add(self, plugin_options):
+        with self._lock:
+            self._options[plugin_options.plugin] = plugin_options
+            self._generation += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+
+    def get(self):
+        """Returns (etag, body) of the current settings, serializing them only after a change."""
+        generation, etag, body = self._cached
+        if generation != self._generation:
+            with self._lock:
+                generation = self._generation  # Changes made while serializing invalidate the result again
+                result = OrderedDict()
+                for plugin in sorted(self._options.keys()):
+                    result[plugin] = self._options[plugin].public()
+                body = json.dumps(result).encode('utf-8')
+                import hashlib
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+                self._cached = (generation, etag, body)
+        return etag, body
+
+
+settings_cache = SettingsCache()
+
+
+class OptionsWriter(Thread):
+    """Writes changed plugin options to the OSPy options in the background.
+
+    Changes are only kept in memory at first. The options of a plugin are
+    written once FLUSH_DELAY seconds passed without another change, or
+    FLUSH_MAX_DELAY seconds after the first unwritten change, so a settings
+    page or a script that changes many values writes each plugin only once.
+
+    Options that could not be written stay pending and are tried again after
+    RETRY_DELAY seconds. Flushes do not overlap, so an older copy of the
+    options is never written after a newer one.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name='Plug-in options writer')
+        self.daemon = True
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._pending = OrderedDict()  # options key -> ManagedPluginOptions
+        self._first = None
+        self._last = None
+        self._retry_at = None
+        self._writes = metrics.counter('ospy_settings_writes_total', 'Plugin options written to the OSPy options.')
+        self._sleeper = scheduler.register(WRITER_NAME)
+        self._metrics = LoopMetrics(metrics, WRITER_NAME)
+        self.start()
+
+    def changed(self, plugin_options):
+        with self._lock:
+            now = time.monotonic()
+            self._pending[plugin_options.options_key] = plugin_options
+            self._last = now
+            if self._first is not None:
+                return  # The loop is already waiting for the delay
+            self._first = now
+        self._sleeper.wake()
+
+    def _delay(self):
+        with self._lock:
+            if self._first is None:
+                return None
+            deadline = min(self._last + FLUSH_DELAY, self._first + FLUSH_MAX_DELAY)
+            if self._retry_at is not None:
+                deadline = max(deadline, self._retry_at)
+            return deadline - time.monotonic()
+
+    def flush(self):
+        """Writes all changed options now. Returns False if some could not be written."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+            self._first = self._last = self._retry_at = None
+
+        failed = []
+        for key, plugin_options in pending:
+            try:
+                options[key] = plugin_options.snapshot()
+                self._writes.inc()
+            except Exception:
+                writer_log.error('Could not save the options of %s:\n%s', key, traceback.format_exc())
+                failed.append((key, plugin_options))
+
+        if failed:
+            with self._lock:
+                now = time.monotonic()
+                for key, plugin_options in failed:
+                    self._pending.setdefault(key, plugin_options)
+                self._first = self._first if self._first is not None else now
+                self._last = self._last if self._last is not None else now
+                self._retry_at = now + RETRY_DELAY
+        return not failed
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                delay = self._delay()
+                if delay is None or delay > 0:
+                    self._sleeper.sleep(delay)
+                elif self.flush():
+                    self._metrics.success(start)
+                else:
+                    self._metrics.failure(start)
+            except Exception:
+                self._metrics.failure(start)
+                writer_log.error('Options writer:\n%s', traceback.format_exc())
+                self._sleeper.sleep(RETRY_DELAY)
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def _options_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = OptionsWriter()
+        return _writer
+
+
+@atexit.register
+def flush_options():
+    """Writes the changed options of all managed plugins, call before OSPy restarts and when a plugin stops."""
+    if _writer is not None:
+        _writer.flush()
+
+
+class ManagedPluginOptions(PluginOptions):
+    """PluginOptions that are served by the aggregate settings of Core Services.
+
+    Keys listed in secrets are redacted in the aggregate settings.
+
+    Changes are visible at once but are written to the OSPy options later by
+    the options writer, see OptionsWriter. Changes of secrets and changes
+    posted by a settings page (web_update) are written before returning.
+    """
+
+    def __init__(self, plugin, defaults, secrets=()):
+        self._deferred = False  # Loading the stored options writes nothing
+        self._lock = Lock()
+        PluginOptions.__init__(self, plugin, defaults)
+        self.plugin = plugin
+        self.secrets = frozenset(secrets)
+        settings_cache.add(self)
+        self._deferred = True
+
+    def __setitem__(self, key, value):
+        if self._deferred:
+            with self._lock:
+                old = self.get(key, _MISSING)
+                dict.__setitem__(self, key, value)
+            if type(old) is not type(value) or old != value:  # Pages set every value, also the unchanged ones
+                _options_writer().changed(self)
+                if key in self.secrets:
+                    flush_options()
+        else:
+            PluginOptions.__setitem__(self, key, value)
+        settings_cache.invalidate()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    @property
+    def options_key(self):
+        """The key PluginOptions stores these options under in the OSPy options."""
+        return self._plugin
+
+    def snapshot(self):
+        """Returns a plain copy of the options, taken while no value is being changed."""
+        with self._lock:
+            return dict(self)
+
+    def web_update(self, qdict, skipped=None):
+        try:
+            PluginOptions.web_update(self, qdict, skipped)
+        finally:
+            settings_cache.invalidate()
+            flush_options()
+
+    def public(self):
+        """Returns a copy of the options with the secrets redacted."""
+        return OrderedDict((key, REDACTED if key in self.secrets and self[key] else self[key])
+                           for key in sorted(self.keys(), key=str))
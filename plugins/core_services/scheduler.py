@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Shared timer for the background loops of the core plug-ins.
+
+import heapq
+import itertools
+import time
+from threading import Thread, Condition, Event
+
+
+class Sleeper(object):
+    """Handle of a plug-in loop registered with the scheduler.
+
+    The owning thread calls sleep(), other threads call wake() to interrupt it.
+    A wake() that arrives while the loop is busy is remembered, so the next
+    sleep() returns immediately instead of losing the request.
+    """
+
+    def __init__(self, scheduler, name):
+        self.name = name
+        self.deadline = None
+        self._scheduler = scheduler
+        self._event = Event()
+        self._entry = None
+
+    def sleep(self, secs=None):
+        """Blocks until secs have passed or wake() is called. Without secs only wake() ends the sleep."""
+        if secs is None:
+            self._event.wait()
+        elif secs > 0 and not self._event.is_set():
+            self._scheduler._schedule(self, time.monotonic() + secs)
+            self._event.wait()
+            self._scheduler._cancel(self)
+        self._event.clear()
+
+    def wake(self):
+        self._event.set()
+
+    def close(self):
+        self._scheduler.unregister(self)
+
+
+class Scheduler(object):
+    """Wakes up sleeping plug-in loops from a single thread.
+
+    All deadlines are kept in one heap. The thread only wakes up when the
+    earliest deadline expires or when the heap changes, so an idle controller
+    does not wake up at all.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._heap = []
+        self._sleepers = []
+        self._counter = itertools.count()
+        self._thread = None
+        self.wakeups = 0
+
+    def register(self, name):
+        """Returns a Sleeper for the loop with the given name."""
+        sleeper = Sleeper(self, name)
+        with self._condition:
+            self._sleepers.append(sleeper)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='Plug-in scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+        return sleeper
+
+    def unregister(self, sleeper):
+        self._cancel(sleeper)
+        with self._condition:
+            if sleeper in self._sleepers:
+                self._sleepers.remove(sleeper)
+
+    def sleepers(self):
+        """Returns a list of (name, seconds until wake-up or None) tuples."""
+        now = time.monotonic()
+        with self._condition:
+            return [(sleeper.name, None if sleeper.deadline is None else max(0, sleeper.deadline - now))
+                    for sleeper in self._sleepers]
+
+    def _schedule(self, sleeper, deadline):
+        with self._condition:
+            sleeper.deadline = deadline
+            sleeper._entry = (deadline, next(self._counter), sleeper)
+            heapq.heappush(self._heap, sleeper._entry)
+            if self._heap[0] is sleeper._entry:
+                self._condition.notify()
+
+    def _cancel(self, sleeper):
+        with self._condition:
+            if sleeper._entry is not None:
+                # The heap only holds one entry per sleeping loop, so this stays cheap.
+                self._heap.remove(sleeper._entry)
+                heapq.heapify(self._heap)
+                sleeper._entry = None
+                sleeper.deadline = None
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if self._heap:
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout > 0:
+                        self._condition.wait(timeout)
+                else:
+                    self._condition.wait()
+                self.wakeups += 1
+
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    sleeper = heapq.heappop(self._heap)[2]
+                    sleeper._entry = None
+                    sleeper.deadline = None
+                    sleeper.wake()
+
+
+scheduler = Scheduler()
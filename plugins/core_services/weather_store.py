@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Hourly weather history of the core plugins, kept on disk across restarts.
+
+import math
+import os
+import struct
+import sys
+from array import array
+from threading import Lock
+
+from ospy.options import options
+
+MAGIC = b'OSPYWX1\0'
+HEADER = struct.Struct('<8sq8s')   # Magic, hour number of the first record, location hash
+FIELDS = 4                         # Temperature, wind speed, humidity, precipitation
+RECORD = struct.Struct('<%df' % FIELDS)
+HISTORY_MARGIN = 31 * 24           # Hours kept free before the first stored hour, for older hours stored later
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'weather.bin')
+
+
+def hour_number(moment):
+    """Returns the number of the hour that contains moment (a datetime or a date)."""
+    return moment.toordinal() * 24 + getattr(moment, 'hour', 0)
+
+
+def _location_hash():
+    import hashlib
+    return hashlib.sha1(str(getattr(options, 'location', '')).encode('utf-8')).digest()[:8]
+
+
+class WeatherStore(object):
+    """Keeps hourly (temperature, wind speed, humidity, precipitation) records in a file.
+
+    All records have the same size and record n holds the hour after the first
+    hour + n, so an hour or a day is read with a single seek. Hours that were
+    never stored read as None. At 16 bytes per hour, a year takes 140 kB.
+    Storing an hour before the first one moves the records back in the file.
+
+    The history is dropped when the location changes. The shared store holds
+    the hourly values as ospy.weather returns them, a plugin that stores
+    values derived from them uses its own file.
+    """
+
+    def __init__(self, path=DATA_PATH):
+        self.path = path
+        self._lock = Lock()
+        self._fh = None
+        self._first = None
+        self._location = None
+
+    def _open(self, create_hour=None):
+        """Opens the file if needed and returns False if there is nothing stored yet."""
+        location = _location_hash()
+        if self._fh is not None and location != self._location:
+            self._reset()
+        if self._fh is None and os.path.exists(self.path):
+            fh = open(self.path, 'r+b')
+            header = fh.read(HEADER.size)
+            if len(header) == HEADER.size and HEADER.unpack(header)[0] == MAGIC and HEADER.unpack(header)[2] == location:
+                self._fh, self._first, self._location = fh, HEADER.unpack(header)[1], location
+            else:
+                fh.close()
+                os.remove(self.path)
+        if self._fh is None and create_hour is not None:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            self._fh = open(self.path, 'w+b')
+            self._first = create_hour - HISTORY_MARGIN
+            self._location = location
+            self._fh.write(HEADER.pack(MAGIC, self._first, location))
+            self._fh.flush()
+        return self._fh is not None
+
+    def _reset(self):
+        self._fh.close()
+        self._fh = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _count(self):
+        self._fh.seek(0, os.SEEK_END)
+        return (self._fh.tell() - HEADER.size) // RECORD.size
+
+    def get(self, first_hour, count):
+        """Returns the records of count hours from hour number first_hour, None for missing hours."""
+        result = [None] * count
+        with self._lock:
+            if not self._open():
+                return result
+            start = max(first_hour, self._first)
+            end = min(first_hour + count, self._first + self._count())
+            if end <= start:
+                return result
+            self._fh.seek(HEADER.size + (start - self._first) * RECORD.size)
+            values = array('f')
+            values.frombytes(self._fh.read((end - start) * RECORD.size))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        for index in range(end - start):
+            record = tuple(values[index * FIELDS:(index + 1) * FIELDS])
+            if not math.isnan(record[0]):
+                result[start - first_hour + index] = record
+        return result
+
+    def day(self, date):
+        """Returns the 24 records of date or None if not all of them are stored."""
+        records = self.get(hour_number(date), 24)
+        return None if None in records else records
+
+    def put(self, first_hour, records):
+        """Stores the records of consecutive hours from hour number first_hour.
+
+        Only hours that are over should be stored, their data does not change anymore.
+        """
+        if not records:
+            return
+        with self._lock:
+            self._open(first_hour)
+            if first_hour < self._first:
+                self._move_first(first_hour - HISTORY_MARGIN)
+            position = first_hour - self._first
+            count = self._count()
+            if position > count:
+                self._fh.seek(0, os.SEEK_END)
+                self._fh.write(RECORD.pack(*([float('nan')] * FIELDS)) * (position - count))
+            self._fh.seek(HEADER.size + position * RECORD.size)
+            self._fh.write(b''.join(RECORD.pack(*record) for record in records))
+            self._fh.flush()
+
+    def _move_first(self, first):
+        """Rewrites the file so it starts at hour number first."""
+        self._fh.seek(HEADER.size)
+        data = self._fh.read()
+        with open(self.path + '.tmp', 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, first, self._location))
+            fh.write(RECORD.pack(*([float('nan')] * FIELDS)) * (self._first - first))
+            fh.write(data)
+        self._fh.close()
+        os.replace(self.path + '.tmp', self.path)
+        self._fh = open(self.path, 'r+b')
+        self._first = first
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def hourly_record(value):
+    """Converts an hourly value of ospy.weather to a record."""
+    return (value.get('temperature', float('nan')), value.get('windSpeed', 0.0),
+            value.get('humidity', 0.0), value.get('precipitation', 0.0))
+
+
+weather_store = WeatherStore()
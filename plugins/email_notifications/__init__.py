@@ -1,22 +1,23 @@
 # !/usr/bin/env python
 # this plugins send email at google email
 
+import base64
 import json
-import time
 import os
 import os.path
+import time
 import traceback
-import smtplib
-from threading import Thread, Event
-
-from email.encoders import encode_base64
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEBase
+import zlib
+from threading import Thread, Event, Lock
 
 import web
 from ospy.webpages import ProtectedPage
-from plugins import PluginOptions, plugin_url
+from plugins import plugin_url
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.options import ManagedPluginOptions, flush_options
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
+from plugins.email_notifications.mail_queue import MailQueue, MAX_ATTEMPTS
 from ospy.options import options
 from ospy.stations import stations
 from ospy.inputs import inputs
@@ -27,7 +28,7 @@ from ospy.helpers import datetime_string, get_input
 NAME = 'Email Notifications'
 LINK = 'settings_page'
 
-email_options = PluginOptions(
+email_options = ManagedPluginOptions(
     NAME,
     {
         'emlpwron': False,
@@ -37,9 +38,75 @@ email_options = PluginOptions(
         'emlusr': '',
         'emlpwd': '',
         'emladr': '',
-        'emlsubject': "Report from OSPy"
-    }
+        'emlsubject': "Report from OSPy",
+        'emllog_max_kb': 1024,
+        'emlhtml': False
+    },
+    secrets=['emlpwd']
 )
+plugin_log = PluginLog(NAME)
+
+SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'spool')
+
+ATTACH_CHUNK = 65536    # Bytes of the attachment read at once
+BASE64_LINE = 57        # Bytes per line of base64 output (76 characters)
+
+
+class FinishedRuns(object):
+    """Cursor over the run log of OSPy that returns every finished run only once.
+
+    OSPy appends a run to the log when it starts and marks it finished in
+    place, so every run before the first one that was still active at the
+    previous poll has been reported already. A poll only looks at the runs
+    from that cursor on, without building log.finished_runs(). When OSPy
+    prunes the front of the log, the cursor is found back by the entry it
+    follows.
+    """
+
+    def __init__(self):
+        self._cursor = 0
+        self._anchor = None     # The log entry just before the cursor
+        self._seen = set()      # Reported runs after the cursor
+        self.poll()  # Skip the runs that finished before we started
+
+    @staticmethod
+    def _key(run):
+        return run['start'], run['station'], run['program_name']
+
+    def _resync(self, entries):
+        """Returns the cursor in entries, which changed when the front of the log was pruned."""
+        for index in range(min(self._cursor, len(entries)) - 1, -1, -1):
+            if entries[index] is self._anchor:
+                return index + 1
+        return 0
+
+    def poll(self):
+        """Returns the runs that finished since the previous poll, oldest first."""
+        entries = log._log['Run']
+        cursor = self._cursor
+        if cursor > len(entries) or (cursor and entries[cursor - 1] is not self._anchor):
+            cursor = self._resync(entries)
+
+        new_runs = []
+        active = None
+        for index in range(cursor, len(entries)):
+            run = entries[index]['data']
+            if run['active']:
+                if active is None:
+                    active = index
+                continue
+            key = self._key(run)
+            if key not in self._seen:
+                self._seen.add(key)
+                new_runs.append(run.copy())
+
+        if active is None:
+            active = len(entries)
+        if active != cursor:
+            self._seen = set(self._key(entry['data']) for entry in entries[active:] if not entry['data']['active'])
+        self._cursor = active
+        self._anchor = entries[active - 1] if active else None
+        return new_runs
 
 
 ################################################################################
@@ -51,32 +118,32 @@ class EmailSender(Thread):
         self.daemon = True
         self._stop_event = Event()
 
-        self._sleep_time = 0
+        self._sleeper = scheduler.register(NAME)
+        self._metrics = LoopMetrics(metrics, NAME)
         self.start()
 
     def stop(self):
         self._stop_event.set()
+        self._sleeper.wake()
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0 and not self._stop_event.is_set():
-            time.sleep(1)
-            self._sleep_time -= 1
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
 
-    def try_mail(self, text, attachment=None):
-        log.clear(NAME)
+    def try_mail(self, text, attachment=None, html=None):
+        plugin_log.clear()
         try:
-            email(text, attach=attachment)  # send email with attachment from
-            log.info(NAME, 'Email was sent:\n' + text)
+            email(text, attach=attachment, html=html)  # queue email with attachment from
+            plugin_log.info('Email was queued:\n%s', text)
         except Exception:
-            log.error(NAME, 'Email was not sent!\n' + traceback.format_exc())
+            plugin_log.error('Email was not queued!\n%s', traceback.format_exc())
 
     def run(self):
         last_rain = False
-        finished_count = len([run for run in log.finished_runs() if not run['blocked']])
+        finished_runs = FinishedRuns()
 
         if email_options["emlpwron"]:  # if eml_power_on send email is enable (on)
             body = (datetime_string() + ': System was powered on.')
@@ -87,6 +154,7 @@ class EmailSender(Thread):
                 self.try_mail(body)
 
         while not self._stop_event.is_set():
+            start = time.monotonic()
             try:
                 # Send E-amil if rain is detected
                 if email_options["emlrain"]:
@@ -97,30 +165,25 @@ class EmailSender(Thread):
 
                 # Send E-mail if a new finished run is found
                 if email_options["emlrun"]:
-                    finished = [run for run in log.finished_runs() if not run['blocked']]
-                    if len(finished) > finished_count:
-                        body = datetime_string() + ':\n'
-                        for run in finished[finished_count:]:
-                            duration = (run['end'] - run['start']).total_seconds()
-                            minutes, seconds = divmod(duration, 60)
-                            body += "Finished run:\n"
-                            body += "  Program: %s\n" % run['program_name']
-                            body += "  Station: %s\n" % stations.get(run['station']).name
-                            body += "  Start time: %s \n" % datetime_string(run['start'])
-                            body += "  Duration: %02d:%02d\n\n" % (minutes, seconds)
-
-                        self.try_mail(body)
-
-                    finished_count = len(finished)
+                    finished = [run for run in finished_runs.poll() if not run['blocked']]
+                    if finished:
+                        body, html = run_report(finished, email_options['emlhtml'])
+                        self.try_mail(body, html=html)
 
+                self._metrics.success(start)
                 self._sleep(5)
 
             except Exception:
-                log.error(NAME, 'E-mail plug-in:\n' + traceback.format_exc())
+                self._metrics.failure(start)
+                plugin_log.error('E-mail plug-in:\n%s', traceback.format_exc())
                 self._sleep(60)
 
+        self._sleeper.close()
+
 
 email_sender = None
+_mail_queue = None
+_mail_queue_lock = Lock()
 
 
 ################################################################################
@@ -130,42 +193,144 @@ def start():
     global email_sender
     if email_sender is None:
         email_sender = EmailSender()
+    get_mail_queue()  # Deliver mail left in the spool
 
 
 def stop():
-    global email_sender
+    global email_sender, _mail_queue
     if email_sender is not None:
         email_sender.stop()
         email_sender.join()
         email_sender = None
+    with _mail_queue_lock:
+        if _mail_queue is not None:
+            _mail_queue.stop()
+            _mail_queue.join()
+            _mail_queue = None
+    flush_options()
 
 
-def email(text, subject=None, attach=None):
-    """Send email with with attachments. If subject is None, the default will be used."""
+def _mail_result(mail_id, error):
+    if error is None:
+        plugin_log.info('Email was sent.')
+    else:
+        plugin_log.error('Email was not sent!\n%s', error)
+
+
+def _mail_retry(mail_id, attempts, delay, error):
+    plugin_log.warning('Email was not sent (attempt %d of %d), trying again in %d seconds:\n%s',
+                       attempts, MAX_ATTEMPTS, delay, error)
+
+
+def get_mail_queue():
+    """Returns the outbound mail queue, starting it if needed."""
+    global _mail_queue
+    with _mail_queue_lock:
+        if _mail_queue is None:
+            _mail_queue = MailQueue(SPOOL_DIR,
+                                    lambda: (email_options['emlusr'], email_options['emlpwd']),
+                                    on_result=_mail_result, on_retry=_mail_retry)
+        return _mail_queue
+
+
+def run_report(runs, with_html=False):
+    """Returns the text and (optionally) the HTML report of the finished runs.
+
+    Every run is formatted once into a row, station names are looked up once
+    for the whole batch and both reports are joined in a single pass.
+    """
+    from html import escape
+    names = dict((index, stations.get(index).name) for index in set(run['station'] for run in runs))
+    rows = []
+    for run in runs:
+        minutes, seconds = divmod((run['end'] - run['start']).total_seconds(), 60)
+        rows.append((run['program_name'], names[run['station']], datetime_string(run['start']),
+                     '%02d:%02d' % (minutes, seconds)))
+
+    header = datetime_string()
+    text = header + ':\n' + ''.join(
+        'Finished run:\n  Program: %s\n  Station: %s\n  Start time: %s \n  Duration: %s\n\n' % row for row in rows)
+    if not with_html:
+        return text, None
+
+    html = ''.join([
+        '<html><body><p>%s: %d finished runs</p>\n' % (escape(header), len(rows)),
+        '<table border="1" cellpadding="4" cellspacing="0">\n',
+        '<tr><th>Program</th><th>Station</th><th>Start time</th><th>Duration</th></tr>\n',
+        ''.join('<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % tuple(escape(str(value)) for value in row)
+                for row in rows),
+        '</table></body></html>\n'])
+    return text, html
+
+
+def _write_base64(fh, data, final=False):
+    """Writes all complete base64 lines of data to fh and returns the remaining bytes."""
+    end = len(data) if final else len(data) - len(data) % BASE64_LINE
+    if end:
+        fh.write(base64.encodebytes(data[:end]))
+    return data[end:]
+
+
+def _write_attachment(fh, attach, max_bytes):
+    """Writes the gzip compressed, base64 encoded contents of attach to fh.
+
+    The file is read in chunks, so memory use does not depend on its size. If
+    the file is larger than max_bytes, only its last lines are attached.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip format
+    pending = b''
+    with open(attach, 'rb') as src:
+        size = os.fstat(src.fileno()).st_size
+        if 0 < max_bytes < size:
+            src.seek(size - max_bytes)
+            src.readline()  # Start at the first complete line
+        for chunk in iter(lambda: src.read(ATTACH_CHUNK), b''):
+            pending = _write_base64(fh, pending + compressor.compress(chunk))
+    _write_base64(fh, pending + compressor.flush(), True)
+
+
+def email(text, subject=None, attach=None, html=None):
+    """Queue email with with attachments. If subject is None, the default will be used.
+
+    If html is given, the message contains both the text and the HTML version.
+    """
+    # Imported here, so OSPy does not load the e-mail packages at startup:
+    import uuid
+    from email.mime.multipart import MIMEMultipart, MIMEBase
+    from email.mime.text import MIMEText
+
     if email_options['emlusr'] != '' and email_options['emlpwd'] != '' and email_options['emladr'] != '':
-        gmail_user = email_options['emlusr']  # User name
         gmail_name = options.name  # OSPi name
-        gmail_pwd = email_options['emlpwd']  # User password
         # --------------
         msg = MIMEMultipart()
         msg['From'] = gmail_name
         msg['To'] = email_options['emladr']
         msg['Subject'] = subject or email_options['emlsubject']
-        msg.attach(MIMEText(text))
+        if html is not None:
+            body = MIMEMultipart('alternative')
+            body.attach(MIMEText(text))
+            body.attach(MIMEText(html, 'html'))
+            msg.attach(body)
+        else:
+            msg.attach(MIMEText(text))
         if attach is not None and os.path.isfile(attach) and os.access(attach, os.R_OK):  # If insert attachments
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(open(attach, 'rb').read())
-            encode_base64(part)
-            part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(attach))
+            # The attachment is streamed into the spool at the place of this placeholder:
+            placeholder = uuid.uuid4().hex
+            part = MIMEBase('application', 'gzip')
+            part.add_header('Content-Transfer-Encoding', 'base64')
+            part.add_header('Content-Disposition', 'attachment; filename="%s.gz"' % os.path.basename(attach))
+            part.set_payload(placeholder)
             msg.attach(part)
-        mail_server = smtplib.SMTP("smtp.gmail.com", 587)
-        mail_server.ehlo()
-        mail_server.starttls()
-        mail_server.ehlo()
-        mail_server.login(gmail_user, gmail_pwd)
-        mail_server.sendmail(gmail_name, email_options['emladr'],
-                             msg.as_string())  # name + e-mail address in the From: field
-        mail_server.close()
+            head, tail = msg.as_string().split(placeholder)
+
+            def message(fh):
+                fh.write(head.encode('utf-8'))
+                _write_attachment(fh, attach, email_options['emllog_max_kb'] * 1024)
+                fh.write(tail.encode('utf-8'))
+        else:
+            message = msg.as_string()
+        get_mail_queue().put(gmail_name, email_options['emladr'],
+                             message)  # name + e-mail address in the From: field
     else:
         raise Exception('E-mail plug-in is not properly configured!')
 
@@ -177,7 +342,7 @@ class settings_page(ProtectedPage):
     """Load an html page for entering email adjustments."""
 
     def GET(self):
-        return self.plugin_render.email_notifications(email_options, log.events(NAME))
+        return self.plugin_render.email_notifications(email_options, plugin_log.events())
 
     def POST(self):
         email_options.web_update(web.input())
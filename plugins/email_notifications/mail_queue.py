@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# Outbound e-mail queue with a reusable SMTP connection and an on-disk spool.
+
+import itertools
+import json
+import os
+import time
+import traceback
+from threading import Thread, Event, Lock
+
+from plugins.core_services.metrics import metrics
+from plugins.core_services.scheduler import scheduler
+
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+SMTP_TIMEOUT = 60       # Seconds to wait for the server
+IDLE_TIMEOUT = 120      # Seconds to keep an unused connection open
+RETRY_DELAY = 60        # Seconds before the first retry, doubled after each failure
+MAX_RETRY_DELAY = 3600
+MAX_ATTEMPTS = 8
+SEND_CHUNK = 16384      # Bytes of message data per socket write
+
+
+def _write_atomic(path, data):
+    """Writes data (bytes or a function writing to a file) to path so that readers never see a partial file."""
+    with open(path + '.tmp', 'wb') as fh:
+        if callable(data):
+            data(fh)
+        else:
+            fh.write(data)
+    os.rename(path + '.tmp', path)
+
+
+def _send_file(server, from_addr, to_addrs, fh):
+    """Like SMTP.sendmail, but streams the message from a binary file instead of holding it in memory."""
+    import smtplib
+    if not isinstance(to_addrs, (list, tuple)):
+        to_addrs = [to_addrs]
+
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    chunk = []
+    size = 0
+    for line in fh:
+        line = line.rstrip(b'\r\n')
+        if line.startswith(b'.'):
+            line = b'.' + line  # Transparency, see RFC 5321 section 4.5.2
+        chunk.append(line + b'\r\n')
+        size += len(line) + 2
+        if size >= SEND_CHUNK:
+            server.send(b''.join(chunk))
+            chunk = []
+            size = 0
+    chunk.append(b'.\r\n')
+    server.send(b''.join(chunk))
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class MailQueue(Thread):
+    """Delivers queued messages from a background thread.
+
+    Every message is stored in the spool directory before put() returns and is
+    only removed after it has been delivered, so queued mail survives a restart.
+    Messages sent shortly after each other share one authenticated connection.
+
+    on_result(mail_id, error) is called when a message is delivered (error is
+    None) or given up, on_retry(mail_id, attempts, delay, error) after every
+    failed attempt that is tried again after delay seconds.
+    """
+
+    def __init__(self, spool_dir, credentials, host=SMTP_HOST, port=SMTP_PORT, use_tls=True, on_result=None,
+                 on_retry=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._stop_event = Event()
+        self._lock = Lock()
+        self._counter = itertools.count()
+        self._spool_dir = spool_dir
+        self._credentials = credentials
+        self._host = host
+        self._port = port
+        self._use_tls = use_tls
+        self._on_result = on_result
+        self._on_retry = on_retry
+
+        self._queue = []
+        self._server = None
+        self._server_login = None
+        self._last_used = 0
+
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self._load()
+
+        self._sleeper = scheduler.register('E-mail queue')
+        self._send_time = metrics.histogram('ospy_smtp_send_seconds', 'Duration of a successful SMTP delivery.')
+        self._send_failures = metrics.counter('ospy_smtp_failures_total', 'Failed SMTP delivery attempts.')
+        self.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._sleeper.wake()
+
+    def put(self, from_addr, to_addrs, message):
+        """Stores the message in the spool and returns its id, delivery happens in the background.
+
+        The message is either its text or a function that writes it to a binary file.
+        """
+        mail_id = '%013d-%d' % (time.time() * 1000, next(self._counter))
+        path = os.path.join(self._spool_dir, mail_id)
+        if not isinstance(message, bytes) and not callable(message):
+            message = message.encode('utf-8')
+        _write_atomic(path + '.eml', message)
+        _write_atomic(path + '.json', json.dumps({'from': from_addr, 'to': to_addrs}).encode('utf-8'))
+
+        with self._lock:
+            self._queue.append(self._item(mail_id, from_addr, to_addrs))
+        self._sleeper.wake()
+        return mail_id
+
+    def pending(self):
+        """Returns the number of messages waiting for delivery."""
+        with self._lock:
+            return len(self._queue)
+
+    @staticmethod
+    def _item(mail_id, from_addr, to_addrs):
+        return {'id': mail_id, 'from': from_addr, 'to': to_addrs, 'attempts': 0, 'next_try': 0}
+
+    def _load(self):
+        """Queues the messages left in the spool by a previous run."""
+        for file_name in sorted(os.listdir(self._spool_dir)):
+            mail_id, ext = os.path.splitext(file_name)
+            if ext != '.json':
+                continue
+            path = os.path.join(self._spool_dir, mail_id)
+            try:
+                with open(path + '.json', 'rb') as fh:
+                    envelope = json.loads(fh.read().decode('utf-8'))
+                if os.path.isfile(path + '.eml'):
+                    self._queue.append(self._item(mail_id, envelope['from'], envelope['to']))
+                    continue
+            except Exception:
+                pass
+            self._remove_files(mail_id)
+
+    def _remove_files(self, mail_id):
+        path = os.path.join(self._spool_dir, mail_id)
+        for ext in ['.eml', '.json']:
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+
+    def _connect(self):
+        login = tuple(self._credentials())
+        if self._server is not None and login != self._server_login:
+            self._disconnect()
+
+        if self._server is None:
+            import smtplib  # Only loaded when the first message is sent
+            server = smtplib.SMTP(self._host, self._port, timeout=SMTP_TIMEOUT)
+            try:
+                server.ehlo()
+                if self._use_tls:
+                    server.starttls()
+                    server.ehlo()
+                if login[0]:
+                    server.login(*login)
+            except Exception:
+                server.close()
+                raise
+            self._server = server
+            self._server_login = login
+        return self._server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+            self._server_login = None
+
+    def _send(self, item, fh):
+        import smtplib
+        reused = self._server is not None
+        try:
+            _send_file(self._connect(), item['from'], item['to'], fh)
+        except smtplib.SMTPServerDisconnected:
+            if not reused:
+                raise
+            # The server closed the idle connection, try once more on a fresh one:
+            self._disconnect()
+            fh.seek(0)
+            _send_file(self._connect(), item['from'], item['to'], fh)
+        self._last_used = time.monotonic()
+
+    def _deliver(self, item):
+        start = time.monotonic()
+        try:
+            with open(os.path.join(self._spool_dir, item['id'] + '.eml'), 'rb') as fh:
+                self._send(item, fh)
+            self._send_time.observe_since(start)
+        except Exception:
+            self._send_failures.inc()
+            self._disconnect()
+            item['attempts'] += 1
+            if item['attempts'] < MAX_ATTEMPTS:
+                delay = min(RETRY_DELAY * 2 ** (item['attempts'] - 1), MAX_RETRY_DELAY)
+                item['next_try'] = time.monotonic() + delay
+                if self._on_retry is not None:
+                    self._on_retry(item['id'], item['attempts'], delay, traceback.format_exc())
+                return
+            error = traceback.format_exc()
+        else:
+            error = None
+
+        with self._lock:
+            self._queue.remove(item)
+        self._remove_files(item['id'])
+        if self._on_result is not None:
+            self._on_result(item['id'], error)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            with self._lock:
+                item = min(self._queue, key=lambda x: (x['next_try'], x['id'])) if self._queue else None
+
+            if item is not None and item['next_try'] <= now:
+                self._deliver(item)
+                continue
+
+            if self._server is not None and now - self._last_used >= IDLE_TIMEOUT:
+                self._disconnect()
+
+            deadlines = []
+            if item is not None:
+                deadlines.append(item['next_try'])
+            if self._server is not None:
+                deadlines.append(self._last_used + IDLE_TIMEOUT)
+            self._sleeper.sleep(min(deadlines) - now if deadlines else None)
+
+        self._disconnect()
+        self._sleeper.close()
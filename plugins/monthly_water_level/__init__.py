@@ -6,26 +6,73 @@ from threading import Thread, Event
 import datetime
 
 import web
-from ospy.log import log
 from ospy.options import level_adjustments
 from ospy.webpages import ProtectedPage
-from plugins import PluginOptions, plugin_url
+from plugins import plugin_url
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.options import ManagedPluginOptions, flush_options
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
 
 
 NAME = 'Monthly Water Level'
 LINK = 'settings_page'
 
-plugin_options = PluginOptions(
-    NAME,
-    {
-        key: 100 for key in range(12)
-    })
+_defaults = {key: 100 for key in range(12)}
+_defaults['smooth'] = False
+plugin_options = ManagedPluginOptions(NAME, _defaults)
+plugin_log = PluginLog(NAME)
 
+REFERENCE_YEAR = 2000  # A leap year, so the table has an entry for every day
+MAX_SLEEP = 86400      # Seconds, the wall clock can jump while the loop sleeps on the monotonic clock
 
-def _sleep_time():
-    """Calculates how long to sleep until just after midnight."""
+
+def _day_index(date):
+    return datetime.date(REFERENCE_YEAR, date.month, date.day).timetuple().tm_yday - 1
+
+
+def build_table():
+    """Returns the water level (%) of every day of the year.
+
+    In smooth mode each monthly value applies to the 15th of its month and the
+    days in between are interpolated linearly, otherwise every day simply gets
+    the value of its month.
+    """
+    days = [datetime.date(REFERENCE_YEAR, 1, 1) + datetime.timedelta(days=day) for day in range(366)]
+    if not plugin_options['smooth']:
+        return [int(plugin_options[day.month - 1]) for day in days]
+
+    anchors = [_day_index(datetime.date(REFERENCE_YEAR, month, 15)) for month in range(1, 13)]
+    table = []
+    for index in range(366):
+        month = max([m for m in range(12) if anchors[m] <= index] or [11])  # Last anchor at or before this day
+        following = (month + 1) % 12
+        span = (anchors[following] - anchors[month]) % 366
+        fraction = ((index - anchors[month]) % 366) / float(span)
+        value = plugin_options[month] + (plugin_options[following] - plugin_options[month]) * fraction
+        table.append(int(round(value)))
+    return table
+
+
+table = build_table()
+
+
+def _sleep_time(today, value):
+    """Calculates how long to sleep until just after the midnight at which the level changes.
+
+    The sleep lasts at most MAX_SLEEP, so the level is checked again at least
+    once a day after the system time was changed. Returns None if the level
+    never changes.
+    """
+    for days in range(1, 367):
+        day = today + datetime.timedelta(days=days)
+        if table[_day_index(day)] != value:
+            break
+    else:
+        return None
     now = datetime.datetime.now()
-    return 5 + 3600 * 24 - (now.second + now.minute * 60 + now.hour * 3600)
+    midnight = datetime.datetime.combine(day, datetime.time())
+    return min(MAX_SLEEP, max(1, (midnight - now).total_seconds() + 5))
 
 
 class MonthChecker(Thread):
@@ -34,28 +81,33 @@ class MonthChecker(Thread):
         self.daemon = True
         self._stop_event = Event()
 
-        self._sleep_time = 0
+        self._sleeper = scheduler.register(NAME)
+        self._metrics = LoopMetrics(metrics, NAME)
         self.start()
 
     def stop(self):
         self._stop_event.set()
+        self._sleeper.wake()
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0 and not self._stop_event.is_set():
-            time.sleep(1)
-            self._sleep_time -= 1
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
 
     def run(self):
         while not self._stop_event.is_set():
-            month = time.localtime().tm_mon - 1  # Current month.
-            level_adjustments[NAME] = plugin_options[month] / 100.0  # Set the water level% (levels list is zero based).
-            log.debug(NAME, 'Monthly Adjust: Setting water level to %d%%' % plugin_options[month])
+            start = time.monotonic()
+            today = datetime.date.today()
+            value = table[_day_index(today)]
+            level_adjustments[NAME] = value / 100.0
+            plugin_log.debug('Monthly Adjust: Setting water level to %d%%', value)
+            self._metrics.success(start)
+
+            self._sleep(_sleep_time(today, value))
 
-            self._sleep(_sleep_time())
+        self._sleeper.close()
 
 
 checker = None
@@ -75,6 +127,7 @@ def stop():
         checker = None
     if NAME in level_adjustments:
         del level_adjustments[NAME]
+    flush_options()
 
 
 class settings_page(ProtectedPage):
@@ -84,12 +137,15 @@ class settings_page(ProtectedPage):
         return self.plugin_render.monthly_water_level(plugin_options)
 
     def POST(self):
+        global table
         qdict = web.input()
         months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
         vals = {}
         for index, month in enumerate(months):
             vals[index] = max(0, min(10000, int(qdict[month])))
+        vals['smooth'] = qdict.get('smooth', 'off')
         plugin_options.web_update(vals)
+        table = build_table()
         if checker is not None:
             checker.update()
         raise web.seeother(plugin_url(settings_page), True)
\ No newline at end of file
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-# This plugin pulses a selected circuit with a 1 Hz signal with adjusted time. (For discover the location of a valve).
+# This plugin pulses a selected circuit with a 1 Hz (adjustable) signal with adjusted time. (For discover the location of a valve).
 
 import json
 import time
@@ -10,17 +10,21 @@ from threading import Thread, Event
 from ospy import helpers
 from ospy.stations import stations
 from ospy.webpages import ProtectedPage
-from plugins import PluginOptions, plugin_url
+from plugins import plugin_url
+from plugins.core_services.options import ManagedPluginOptions, flush_options
 from ospy.log import log
 
 NAME = 'Pulse Output Test'
 LINK = 'start_page'
 
-pulse_options = PluginOptions(
+pulse_options = ManagedPluginOptions(
     NAME,
     {
         'test_time': 30,
-        'test_output': 0
+        'test_output': 0,
+        'frequency': 1.0,
+        'duty_cycle': 50,
+        'sweep': False
     }
 )
 
@@ -31,34 +35,63 @@ class PulseSender(Thread):
         self.daemon = True
         self._stop_event = Event()
 
-        self._sleep_time = 0
+        self._jitter_count = 0
+        self._jitter_sum = 0.0
+        self._jitter_max = 0.0
         self.start()
 
     def stop(self):
         self._stop_event.set()
 
-    def update(self):
-        self._sleep_time = 0
-
-    def run(self):
-        log.clear(NAME)
-        log.info(NAME, 'Test started for ' + str(pulse_options['test_time']) + ' sec.')
-        station = stations.get(pulse_options['test_output'])
-
-        for x in range(0, pulse_options['test_time']):
+    def _wait_until(self, deadline):
+        """Waits until the monotonic deadline and records how late we are."""
+        remaining = deadline - time.monotonic()
+        if remaining > 0 and self._stop_event.wait(remaining):
+            return  # Stopped early
+        jitter = abs(time.monotonic() - deadline)
+        self._jitter_count += 1
+        self._jitter_sum += jitter
+        self._jitter_max = max(self._jitter_max, jitter)
+
+    def _pulse(self, station, seconds, frequency, duty_cycle):
+        """Pulses the station, all edges are scheduled from the start time so errors do not add up."""
+        period = 1.0 / frequency
+        on_time = period * duty_cycle / 100.0
+        start = time.monotonic()
+        for cycle in range(int(round(seconds * frequency))):
+            switch_on = start + cycle * period
+            self._wait_until(switch_on)
+            if self._stop_event.is_set():
+                break
             station.active = True
-            time.sleep(0.5)
+            self._wait_until(switch_on + on_time)
             station.active = False
-            time.sleep(0.5)
 
+        # Activate again if needed:
+        if station.remaining_seconds != 0:
+            station.active = True
+
+    def run(self):
+        log.clear(NAME)
+        frequency = max(0.1, min(50.0, pulse_options['frequency']))
+        duty_cycle = max(1, min(99, pulse_options['duty_cycle']))
+        if pulse_options['sweep']:
+            test_stations = stations.enabled_stations()
+        else:
+            test_stations = [stations.get(pulse_options['test_output'])]
+        log.info(NAME, 'Test started for ' + str(pulse_options['test_time']) + ' sec. (%.1f Hz, %d%%)' % (frequency, duty_cycle))
+
+        for station in test_stations:
             if self._stop_event.is_set():
                 break
+            if len(test_stations) > 1:
+                log.info(NAME, 'Pulsing ' + station.name + '.')
+            self._pulse(station, pulse_options['test_time'], frequency, duty_cycle)
 
         log.info(NAME, 'Test stopped.')
-
-        # Activate again if needed:
-        if station.remaining_seconds != 0:
-            station.active = True
+        if self._jitter_count:
+            log.info(NAME, 'Timing jitter: %.1f ms average, %.1f ms maximum.' % (
+                1000 * self._jitter_sum / self._jitter_count, 1000 * self._jitter_max))
 
 
 sender = None
@@ -71,7 +104,8 @@ def start():
     pass
 
 
-stop = start
+def stop():
+    flush_options()
 
 
 ################################################################################
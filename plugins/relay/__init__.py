@@ -1,30 +1,118 @@
 # !/usr/bin/env python
 
-import time
+import json
+import traceback
 import web
 
+from threading import Thread, Event, Lock
+
+from ospy.helpers import get_input
 from ospy.webpages import ProtectedPage
 from ospy.outputs import outputs
+from plugins.core_services.options import ManagedPluginOptions, flush_options
 
 NAME = 'Relay Test'
 LINK = 'test_page'
 
+relay_options = ManagedPluginOptions(
+    NAME,
+    {
+        'on_time': 3,
+        'pulses': 1
+    }
+)
 
-class test_page(ProtectedPage):
-    """Test relay by turning it on for a short time, then off."""
 
-    def GET(self):
+class RelayTest(Thread):
+    """Switches the relay on and off in the background."""
+
+    def __init__(self, on_time, pulses):
+        Thread.__init__(self)
+        self.daemon = True
+        self._stop_event = Event()
+        self.status = {
+            'state': 'running',
+            'on_time': on_time,
+            'pulses': pulses,
+            'pulse': 0,
+            'result': None}
+        self.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
         try:
-            outputs.relay_output = True
-            time.sleep(3)
-            outputs.relay_output = False
+            for pulse in range(self.status['pulses']):
+                if pulse > 0 and self._stop_event.wait(self.status['on_time']):
+                    break
+                self.status['pulse'] = pulse + 1
+                outputs.relay_output = True
+                self._stop_event.wait(self.status['on_time'])
+                outputs.relay_output = False
+            self.status['result'] = 'Stopped.' if self._stop_event.is_set() else 'OK.'
         except Exception:
-            pass
-        raise web.seeother('/')  # return to home page
+            self.status['result'] = traceback.format_exc()
+        finally:
+            try:
+                outputs.relay_output = False
+            except Exception:
+                pass
+            self.status['state'] = 'finished'
+
+
+job = None
+_job_lock = Lock()
 
 
+################################################################################
+# Helper functions:                                                            #
+################################################################################
 def start():
     pass
 
 
-stop = start
+def stop():
+    global job
+    with _job_lock:
+        if job is not None:
+            job.stop()
+            job.join()
+            job = None
+    flush_options()
+
+
+def _start_test(on_time, pulses):
+    global job
+    with _job_lock:
+        if job is None or not job.is_alive():  # Only one test at a time
+            job = RelayTest(max(1, min(60, on_time)), max(1, min(100, pulses)))
+
+
+################################################################################
+# Web pages:                                                                   #
+################################################################################
+class test_page(ProtectedPage):
+    """Test relay by turning it on for a short time, then off."""
+
+    def GET(self):
+        qdict = web.input()
+        _start_test(get_input(qdict, 'on_time', relay_options['on_time'], int),
+                    get_input(qdict, 'pulses', relay_options['pulses'], int))
+        raise web.seeother('/')  # return to home page
+
+    def POST(self):
+        relay_options.web_update(web.input())
+        _start_test(relay_options['on_time'], relay_options['pulses'])
+        raise web.seeother('/')  # return to home page
+
+
+class status_json(ProtectedPage):
+    """Returns the state of the last relay test in JSON format."""
+
+    def GET(self):
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        if job is None:
+            return json.dumps({'state': 'idle'})
+        return json.dumps(job.status)
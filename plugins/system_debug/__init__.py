@@ -1,67 +1,450 @@
 #!/usr/bin/env python
-# this plugins print debug info from ./data/events.log 
+# this plugins print debug info from ./data/events.log
 
 from ospy.webpages import ProtectedPage
 from ospy import log
 from ospy import helpers
 
 from plugins import plugin_url
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
+from plugins.system_debug.log_segments import LogSegments, TIME_RE
+from array import array
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+from urllib.parse import urlencode
+import datetime
+import json
+import logging
+import re
+import time
+import traceback
 import web
 import os
 
 NAME = 'System Debug Information'
 LINK = 'status_page'
 
+plugin_log = PluginLog(NAME)
+
+PAGE_LINES = 500
+BLOCK_LINES = 256       # Lines read at once while filtering
+READ_SIZE = 65536       # Bytes read at once while indexing
+FOLLOW_MAX = 65536      # Maximum number of bytes returned by follow_json
+
+ROTATE_SIZE = 512 * 1024        # Bytes in the event log that are moved into a compressed segment
+ROTATE_AGE = 7 * 24 * 3600      # Seconds after which lines are moved into a segment anyway
+DISK_CAP = 4 * 1024 * 1024      # Bytes all segments may take together, the oldest ones are removed
+ROTATE_CHECK = 900              # Seconds between checks of the event log
+ROTATING_SUFFIX = '.rotating'   # The event log while it is being compressed
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+_LEVEL_CODES = {b'DEBUG': 0, b'INFO': 1, b'WARNING': 2, b'ERROR': 3, b'CRITICAL': 3}
+_LEVEL_RE = re.compile(br'\b(DEBUG|INFO|WARNING|ERROR|CRITICAL)\b')
+
 
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
+def _line_level(line, previous):
+    """Returns the level of a line, lines without a time stamp continue the previous message."""
+    if TIME_RE.match(line):
+        match = _LEVEL_RE.search(line, 0, 80)
+        if match is not None:
+            return _LEVEL_CODES[match.group(1)]
+    return previous
+
+
+class LogIndex(object):
+    """Index of the byte offsets and levels of the lines in a log file.
+
+    The index is extended with the lines appended since the previous call and
+    rebuilt when the file was truncated or replaced, so reading any range of
+    lines only costs the lines that are read.
+
+    Lines that were moved into compressed segments keep their numbers and are
+    read from the segment block that holds them.
+    """
+
+    def __init__(self, path, segments):
+        self._path = path
+        self._segments = segments
+        self._lock = Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        self._inode = inode
+        self._offsets = array('L')
+        self._levels = array('B')
+        self._end = 0
+        self._level = 0
+        self._base_line = self._base_byte = None  # Read from the segments on first use
+
+    def _load_base(self):
+        if self._base_line is None:
+            self._base_line, self._base_byte = self._segments.end()
+
+    def reset(self):
+        """Rebuilds the index on the next call, after the file was rotated or deleted."""
+        with self._lock:
+            self._reset(None)
+
+    def refresh(self):
+        """Indexes the complete lines appended to the file. Returns the number of lines."""
+        with self._lock:
+            try:
+                stat = os.stat(self._path)
+            except OSError:
+                self._reset(None)
+                self._load_base()
+                return self._base_line
+
+            if stat.st_ino != self._inode or stat.st_size < self._end:
+                self._reset(stat.st_ino)
+            self._load_base()
+
+            if stat.st_size > self._end:
+                with open(self._path, 'rb') as fh:
+                    fh.seek(self._end)
+                    data = b''
+                    while True:
+                        chunk = fh.read(READ_SIZE)
+                        if not chunk:
+                            break
+                        data += chunk
+                        pos = 0
+                        while True:
+                            newline = data.find(b'\n', pos)
+                            if newline < 0:
+                                break
+                            self._add_line(self._end + pos, data[pos:newline])
+                            pos = newline + 1
+                        self._end += pos
+                        data = data[pos:]
+
+            return self._base_line + len(self._offsets)
+
+    def _add_line(self, offset, line):
+        self._level = _line_level(line, self._level)
+        self._offsets.append(offset)
+        self._levels.append(self._level)
+
+    def _read(self, fh, first, last):
+        """Returns the lines first up to and including last (as bytes)."""
+        begin = self._offsets[first]
+        end = self._offsets[last + 1] if last + 1 < len(self._offsets) else self._end
+        fh.seek(begin)
+        return fh.read(end - begin).split(b'\n')
+
+    def lines(self, start, count, min_level=0, plugin=None, reverse=False):
+        """Returns up to count (number, line) tuples matching the filter.
+
+        Lines are searched from line number start onwards, or backwards when
+        reverse is set. The result is always ordered from old to new.
+        """
+        self.refresh()
+        result = []
+        with self._lock:
+            self._load_base()
+            try:
+                fh = open(self._path, 'rb')
+                total = self._base_line + len(self._offsets)
+            except IOError:
+                fh = None
+                total = self._base_line
+            try:
+                oldest = self._segments.first_line(self._base_line)
+                number = min(max(start, oldest), total - 1)
+                while oldest <= number < total and len(result) < count:
+                    if number >= self._base_line:
+                        block, number = self._live_block(fh, number, reverse, min_level)
+                    else:
+                        block, number = self._segment_block(number, reverse, min_level)
+                    for x, line in block:
+                        line = line.decode('utf-8', 'replace')
+                        if plugin and plugin not in line:
+                            continue
+                        result.append((x, line))
+                        if len(result) >= count:
+                            break
+            finally:
+                if fh is not None:
+                    fh.close()
+        if reverse:
+            result.reverse()
+        return result
+
+    def _live_block(self, fh, number, reverse, min_level):
+        """Returns the (number, line) tuples of a block of the log file and the number to continue with."""
+        local = number - self._base_line
+        block = range(local, max(local - BLOCK_LINES, -1), -1) if reverse else \
+            range(local, min(local + BLOCK_LINES, len(self._offsets)))
+        following = self._base_line + block[-1] + (-1 if reverse else 1)
+        selected = [x for x in block if self._levels[x] >= min_level]
+        if not selected:
+            return [], following
+        first, last = min(selected), max(selected)
+        text = self._read(fh, first, last)
+        return [(self._base_line + x, text[x - first]) for x in selected], following
+
+    def _segment_block(self, number, reverse, min_level):
+        """Returns the (number, line) tuples of a segment block and the number to continue with."""
+        first, lines = self._segments.lines_at(number)
+        if first is None:  # The segment was removed meanwhile
+            return [], -1 if reverse else self._base_line
+        levels = []
+        level = 0
+        for line in lines:
+            level = _line_level(line, level)
+            levels.append(level)
+        local = number - first
+        block = range(local, -1, -1) if reverse else range(local, len(lines))
+        following = first - 1 if reverse else first + len(lines)
+        return [(first + x, lines[x]) for x in block if levels[x] >= min_level], following
+
+    def find_time(self, timestamp):
+        """Returns the number of the first line logged at or after timestamp (like '2015-02-17 09:57')."""
+        self.refresh()
+        timestamp = timestamp.encode('utf-8')
+        with self._lock:
+            self._load_base()
+            total = len(self._offsets)
+            fh = open(self._path, 'rb') if total else None
+            try:
+                first = self._next_time(fh, 0, total)[1] if fh is not None else None
+                if fh is None or (first is not None and first > timestamp):
+                    number = self._segments.find_time(timestamp)
+                    if number is not None:
+                        return number
+                if fh is None:
+                    return self._base_line
+                low, high = 0, total
+                while low < high:
+                    middle = (low + high) // 2
+                    number, stamp = self._next_time(fh, middle, high)
+                    if stamp is None or stamp >= timestamp:
+                        high = middle
+                    else:
+                        low = number + 1
+                # low can be a line that continues a message, the message that follows is the result:
+                return self._base_line + self._next_time(fh, low, total)[0]
+            finally:
+                if fh is not None:
+                    fh.close()
+
+    def _next_time(self, fh, number, limit):
+        """Returns the number and time stamp of the first line at or after number that has a time stamp."""
+        while number < limit:
+            fh.seek(self._offsets[number])
+            match = TIME_RE.match(fh.readline())
+            if match is not None:
+                return number, match.group(0)
+            number += 1
+        return number, None
+
+    def follow(self, offset):
+        """Returns (new offset, text) of the complete lines appended after byte offset.
+
+        Offsets count all bytes ever logged, so they stay valid when the file is rotated.
+        """
+        self.refresh()
+        with self._lock:
+            self._load_base()
+            offset -= self._base_byte
+            if offset < 0 or offset > self._end:
+                offset = 0  # The file was rotated or truncated
+            end = min(self._end, offset + FOLLOW_MAX)
+            if end < self._end:
+                # Only return complete lines, but at least one:
+                line = self._line_at(end)
+                end = self._offsets[line]
+                if end <= offset:
+                    end = self._offsets[line + 1] if line + 1 < len(self._offsets) else self._end
+            if end <= offset:
+                return self._base_byte + offset, ''
+            with open(self._path, 'rb') as fh:
+                fh.seek(offset)
+                return self._base_byte + end, fh.read(end - offset).decode('utf-8', 'replace')
+
+    def _line_at(self, offset):
+        low, high = 0, len(self._offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self._offsets[middle] <= offset:
+                low = middle + 1
+            else:
+                high = middle
+        return max(low - 1, 0)
+
+    def first_line(self):
+        """Returns the number of the oldest line that is kept."""
+        with self._lock:
+            self._load_base()
+            return self._segments.first_line(self._base_line)
+
+    def size(self):
+        """Returns the number of bytes indexed, including the rotated ones."""
+        with self._lock:
+            self._load_base()
+            return self._base_byte + self._end
+
+
+event_segments = LogSegments(log.EVENT_FILE)
+event_index = LogIndex(log.EVENT_FILE, event_segments)
+
+
+@contextmanager
+def _writers_paused():
+    """Holds the locks of the logging handlers that write the event log, flushes them and yields them."""
+    path = os.path.abspath(log.EVENT_FILE)
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    handlers = set(handler for logger in loggers for handler in logger.handlers
+                   if isinstance(handler, logging.FileHandler) and handler.baseFilename == path)
+    for handler in handlers:
+        handler.acquire()
+        handler.flush()
+    try:
+        yield handlers
+    finally:
+        for handler in handlers:
+            handler.release()
+
+
+def _first_time(path):
+    """Returns the time of the first line of a log file as a datetime, or None."""
+    with open(path, 'rb') as fh:
+        match = TIME_RE.match(fh.read(32))
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(0).decode('ascii').replace('T', ' '), '%Y-%m-%d %H:%M:%S')
+
+
+def needs_rotation():
+    if os.path.exists(log.EVENT_FILE + ROTATING_SUFFIX):
+        return True  # A previous rotation was interrupted
+    try:
+        size = os.path.getsize(log.EVENT_FILE)
+        first = _first_time(log.EVENT_FILE) if size else None
+    except (IOError, OSError):
+        return False
+    return size >= ROTATE_SIZE or \
+        (first is not None and first < datetime.datetime.now() - datetime.timedelta(seconds=ROTATE_AGE))
+
+
+def rotate_events():
+    """Moves the event log into a new compressed segment.
+
+    The event log is renamed and the streams of the log handlers are closed,
+    both while the handlers are paused, so no line is written to the renamed
+    file after that and the next line opens a new file. It is compressed
+    afterwards, a block at a time. Nothing is rotated when OSPy does not
+    write the event log through a handler of this process.
+    """
+    rotating = log.EVENT_FILE + ROTATING_SUFFIX
+    if not os.path.exists(rotating):  # Otherwise a previous rotation was interrupted
+        with _writers_paused() as handlers:
+            if not handlers:
+                return False
+            os.rename(log.EVENT_FILE, rotating)
+            for handler in handlers:
+                # Without a stream, a FileHandler opens its file again on the next record:
+                stream = handler.setStream(None)
+                if stream is not None:
+                    stream.close()
+
+    with open(rotating, 'rb') as fh:
+        event_segments.write(fh)
+    os.remove(rotating)
+    event_segments.trim(DISK_CAP)
+    event_index.reset()
+    return True
+
+
+class LogRotator(Thread):
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._stop_event = Event()
+
+        self._sleeper = scheduler.register(NAME)
+        self._metrics = LoopMetrics(metrics, NAME)
+        self.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._sleeper.wake()
+
+    def _sleep(self, secs):
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                if needs_rotation() and not rotate_events():
+                    plugin_log.debug('The event log is not written by this process, it is not rotated.')
+                self._metrics.success(start)
+                self._sleep(ROTATE_CHECK)
+
+            except Exception:
+                self._metrics.failure(start)
+                plugin_log.error('Event log rotation:\n%s', traceback.format_exc())
+                self._sleep(ROTATE_CHECK)
+
+        self._sleeper.close()
+
+
+rotator = None
+
+
 def start():
-    pass
-
-
-stop = start
-
-
-def tail(f, lines=20):
-    total_lines_wanted = lines
-
-    BLOCK_SIZE = 1024
-    f.seek(0, 2)
-    block_end_byte = f.tell()
-    lines_to_go = total_lines_wanted+1
-    block_number = -1
-    blocks = [] # blocks of size BLOCK_SIZE, in reverse order starting
-                # from the end of the file
-    while lines_to_go > 0 and block_end_byte > 0:
-        if (block_end_byte - BLOCK_SIZE > 0):
-            # read the last block we haven't yet read
-            f.seek(block_number*BLOCK_SIZE, 2)
-            blocks.append(f.read(BLOCK_SIZE))
-        else:
-            # file too small, start from begining
-            f.seek(0,0)
-            # only read what was not read
-            blocks.append(f.read(block_end_byte))
-        lines_found = blocks[-1].count(b'\n')
-        lines_to_go -= lines_found
-        block_end_byte -= BLOCK_SIZE
-        block_number -= 1
-    all_read_text = (b''.join(reversed(blocks))).decode('utf-8')
-    return all_read_text.splitlines()[-total_lines_wanted:]
-
-
-def get_overview():
-    """Returns the info data as a list of lines."""
-    result = []
+    global rotator
+    if rotator is None:
+        rotator = LogRotator()
+
+
+def stop():
+    global rotator
+    if rotator is not None:
+        rotator.stop()
+        rotator.join()
+        rotator = None
+
+
+def get_overview(start=None, min_level=0, plugin=None, reverse=True):
+    """Returns a page of the info data as a list of (number, line) tuples."""
     try:
-        with open(log.EVENT_FILE, 'rb') as fh:
-            result = tail(fh, 500)
+        if start is None:
+            start = event_index.refresh() - 1
+        return event_index.lines(start, PAGE_LINES, min_level, plugin, reverse)
     except Exception:
         import traceback
-        result = traceback.format_exc().split('\n')
+        return [(-1, line) for line in traceback.format_exc().split('\n')]
+
 
-    return result
+def _page_options(qdict):
+    level = helpers.get_input(qdict, 'level', 'DEBUG')
+    return {
+        'start': helpers.get_input(qdict, 'start', None, int),
+        'min_level': LEVELS.index(level) if level in LEVELS else 0,
+        'plugin': helpers.get_input(qdict, 'plugin', '').strip() or None,
+        'reverse': helpers.get_input(qdict, 'direction', 'back') != 'forward'
+    }
+
+
+def _page_links(level, plugin, lines):
+    """Returns the query strings of the Older, Newer and Newest buttons, None if there is nothing to show."""
+    query = [('level', level), ('plugin', plugin or '')]
+    first = lines[0][0] if lines else 0
+    last = lines[-1][0] if lines else -1
+    return {
+        'older': urlencode(query + [('start', first - 1)]) if lines and first > event_index.first_line() else None,
+        'newer': urlencode(query + [('start', last + 1), ('direction', 'forward')]),
+        'newest': urlencode(query)
+    }
 
 
 ################################################################################
@@ -78,7 +461,41 @@ class status_page(ProtectedPage):
                 os.remove(log.EVENT_FILE)
             except Exception:
                 pass
+            event_segments.remove_all()
+            event_index.reset()
             raise web.seeother(plugin_url(status_page), True)
 
-        return self.plugin_render.system_debug(get_overview())
+        page = _page_options(qdict)
+        time_stamp = helpers.get_input(qdict, 'time', '').strip()
+        if time_stamp:
+            page['start'] = event_index.find_time(time_stamp)
+            page['reverse'] = False
+        lines = get_overview(**page)
+        level = LEVELS[page['min_level']]
+        return self.plugin_render.system_debug([line for number, line in lines],
+                                               LEVELS,
+                                               _page_links(level, page['plugin'], lines),
+                                               event_index.size(),
+                                               event_segments.disk_usage(),
+                                               dict(qdict, level=level, plugin=page['plugin'] or ''))
+
 
+class lines_json(ProtectedPage):
+    """Returns a page of the event log in JSON format."""
+
+    def GET(self):
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        page = _page_options(web.input())
+        return json.dumps([{'line': number, 'text': line} for number, line in get_overview(**page)])
+
+
+class follow_json(ProtectedPage):
+    """Returns the text appended to the event log since the given byte offset in JSON format."""
+
+    def GET(self):
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        offset = helpers.get_input(web.input(), 'offset', 0, int)
+        offset, text = event_index.follow(offset)
+        return json.dumps({'offset': offset, 'text': text})
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# Compressed segments of the event log, readable one block at a time.
+
+import os
+import re
+import struct
+import time
+import zlib
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+TIME_RE = re.compile(br'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}')
+
+MEMBER_SIZE = 65536     # Bytes of log lines compressed together
+READ_SIZE = 65536       # Bytes read at once from the file that is stored
+COMPRESS_LEVEL = 6
+CACHE_MEMBERS = 4       # Decompressed blocks kept in memory
+
+_MAGIC = b'\x1f\x8b\x08\x04'               # gzip, deflate, extra field present
+_HEADER = struct.Struct('<4sIBBH')          # Magic, time, extra flags, OS, extra length
+_EXTRA = struct.Struct('<2sHIIIQQ')         # Id, length, member size, data size, lines, first line, first byte
+_EXTRA_ID = b'OL'
+_TRAILER = struct.Struct('<II')             # CRC32 and size of the data
+
+Member = namedtuple('Member', 'offset size length lines first_line first_byte')
+
+
+def _split(data):
+    """Splits complete lines into blocks of about MEMBER_SIZE bytes, never inside a multi-line message."""
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + MEMBER_SIZE - 1)
+        while 0 <= end < len(data) - 1 and not TIME_RE.match(data, end + 1):
+            end = data.find(b'\n', end + 1)
+        end = len(data) if end < 0 or end >= len(data) - 1 else end + 1
+        yield data[start:end]
+        start = end
+
+
+def _blocks(fh):
+    """Yields the blocks of _split() of the binary file fh, reading it in chunks of READ_SIZE bytes.
+
+    The last block of what was read so far is only yielded at the end of the
+    file, as it may continue in the next chunk. A missing final newline is added.
+    """
+    pending = b''
+    for chunk in iter(lambda: fh.read(READ_SIZE), b''):
+        pending += chunk
+        if len(pending) < 2 * MEMBER_SIZE:
+            continue
+        blocks = list(_split(pending))
+        for block in blocks[:-1]:
+            yield block
+        pending = blocks[-1]
+    if pending and not pending.endswith(b'\n'):
+        pending += b'\n'
+    for block in _split(pending):
+        yield block
+
+
+def _member(block, first_line, first_byte):
+    """Returns block as a gzip member that records its own size and line numbers in the extra field."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+    size = _HEADER.size + _EXTRA.size + len(body) + _TRAILER.size
+    return b''.join([
+        _HEADER.pack(_MAGIC, int(time.time()), 0, 255, _EXTRA.size),
+        _EXTRA.pack(_EXTRA_ID, _EXTRA.size - 4, size, len(block), block.count(b'\n'), first_line, first_byte),
+        body,
+        _TRAILER.pack(zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)])
+
+
+class Segment(object):
+    """One compressed segment of the event log.
+
+    A segment is a normal gzip file (zcat can read it) made of independent
+    members of about MEMBER_SIZE bytes of log lines each. Every member header
+    holds the size of the member and the number of its first line, so a line
+    is found by reading the headers and decompressing only one member.
+    """
+
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self.size = os.path.getsize(path)
+        self._members = None
+
+    def members(self):
+        if self._members is None:
+            members = []
+            with open(self.path, 'rb') as fh:
+                offset = 0
+                while offset < self.size:
+                    fh.seek(offset)
+                    head = fh.read(_HEADER.size + _EXTRA.size)
+                    if len(head) < _HEADER.size + _EXTRA.size:
+                        raise IOError('%s is truncated' % self.path)
+                    magic, _, _, _, extra_size = _HEADER.unpack_from(head)
+                    fields = _EXTRA.unpack_from(head, _HEADER.size)
+                    if magic != _MAGIC or extra_size != _EXTRA.size or fields[0] != _EXTRA_ID:
+                        raise IOError('%s is not an event log segment' % self.path)
+                    members.append(Member(offset, *fields[2:]))
+                    offset += fields[2]
+            self._members = members
+        return self._members
+
+    def _compressed(self, member, limit=None):
+        with open(self.path, 'rb') as fh:
+            fh.seek(member.offset)
+            return fh.read(member.size if limit is None else min(member.size, limit))
+
+    def read(self, member):
+        """Returns the lines of a member (as bytes)."""
+        return zlib.decompress(self._compressed(member), 16 + zlib.MAX_WBITS).split(b'\n')[:-1]
+
+    def first_time(self, member):
+        """Returns the time stamp of the first line of a member, only decompressing its start."""
+        text = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(self._compressed(member, 4096), 64)
+        match = TIME_RE.match(text)
+        return match.group(0) if match is not None else None
+
+
+class LogSegments(object):
+    """The compressed segments of a log file, named <log file>.<number>.gz.
+
+    Lines keep their number when they are moved from the log file into a
+    segment, so line numbers only change when everything is deleted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._segments = None
+        self._cache = OrderedDict()  # (segment number, member offset) -> lines
+
+    def _scan(self):
+        folder, name = os.path.split(self.path)
+        pattern = re.compile(re.escape(name) + r'\.(\d+)\.gz$')
+        try:
+            names = os.listdir(folder or '.')
+        except OSError:
+            return []
+        result = []
+        for filename in names:
+            match = pattern.match(filename)
+            if match is None:
+                continue
+            try:
+                segment = Segment(os.path.join(folder, filename), int(match.group(1)))
+                if segment.members():
+                    result.append(segment)
+            except (IOError, OSError):
+                pass  # Not written by us or damaged, leave it alone
+        return sorted(result, key=lambda segment: segment.number)
+
+    def _invalidate(self):
+        self._segments = None
+        self._cache.clear()
+
+    def segments(self):
+        """Returns the segments, oldest first."""
+        with self._lock:
+            if self._segments is None:
+                self._segments = self._scan()
+            return list(self._segments)
+
+    def disk_usage(self):
+        """Returns the number of segments and the bytes they take."""
+        segments = self.segments()
+        return len(segments), sum(segment.size for segment in segments)
+
+    def first_line(self, default):
+        """Returns the number of the oldest line kept in the segments, or default if there are none."""
+        segments = self.segments()
+        return segments[0].members()[0].first_line if segments else default
+
+    def end(self):
+        """Returns the (line number, byte offset) following the newest segment."""
+        segments = self.segments()
+        if not segments:
+            return 0, 0
+        last = segments[-1].members()[-1]
+        return last.first_line + last.lines, last.first_byte + last.length
+
+    def lines_at(self, number):
+        """Returns (number of the first line, lines) of the block that holds line number, or (None, [])."""
+        for segment in reversed(self.segments()):
+            for member in segment.members():
+                if member.first_line <= number < member.first_line + member.lines:
+                    return member.first_line, self._read(segment, member)
+        return None, []
+
+    def _read(self, segment, member):
+        key = (segment.number, member.offset)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        lines = segment.read(member)
+        with self._lock:
+            self._cache[key] = lines
+            while len(self._cache) > CACHE_MEMBERS:
+                self._cache.popitem(last=False)
+        return lines
+
+    def find_time(self, timestamp):
+        """Returns the number of the first line logged at or after timestamp (bytes), or None if all are older."""
+        members = [(segment, member) for segment in self.segments() for member in segment.members()]
+        low, high = 0, len(members)
+        while low < high:
+            middle = (low + high) // 2
+            stamp = members[middle][0].first_time(members[middle][1])
+            if stamp is not None and stamp >= timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        if low > 0:  # The end of the previous block can already be at or after the time stamp
+            segment, member = members[low - 1]
+            for index, line in enumerate(self._read(segment, member)):
+                match = TIME_RE.match(line)
+                if match is not None and match.group(0) >= timestamp:
+                    return member.first_line + index
+        return members[low][1].first_line if low < len(members) else None
+
+    def write(self, source):
+        """Stores the lines of source (a binary file) as a new segment after the newest one.
+
+        The file is read in chunks, so memory use does not depend on its size.
+        Returns False if it was empty.
+        """
+        segments = self.segments()
+        first_line, first_byte = self.end()
+        start_byte = first_byte
+        path = '%s.%06d.gz' % (self.path, segments[-1].number + 1 if segments else 1)
+        with open(path + '.tmp', 'wb') as fh:
+            for block in _blocks(source):
+                fh.write(_member(block, first_line, first_byte))
+                first_line += block.count(b'\n')
+                first_byte += len(block)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if first_byte == start_byte:
+            os.remove(path + '.tmp')
+            return False
+        os.replace(path + '.tmp', path)
+        with self._lock:
+            self._invalidate()
+        return True
+
+    def trim(self, cap):
+        """Removes the oldest segments until all take at most cap bytes, but always keeps the newest one."""
+        segments = self.segments()
+        total = sum(segment.size for segment in segments)
+        for segment in segments[:-1]:
+            if total <= cap:
+                break
+            os.remove(segment.path)
+            total -= segment.size
+        with self._lock:
+            self._invalidate()
+
+    def remove_all(self):
+        for segment in self.segments():
+            os.remove(segment.path)
+        with self._lock:
+            self._invalidate()
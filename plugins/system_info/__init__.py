@@ -1,70 +1,197 @@
 #!/usr/bin/env python
-# this plugins print system info os on web 
+# this plugins print system info os on web
 
-import platform
 from collections import OrderedDict
+from threading import Thread, Event
 
+import json
+import os
+import time
 import traceback
+import web
 from ospy import helpers
 from ospy.webpages import ProtectedPage
 from ospy.options import options
-import subprocess
-from ospy.log import log
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
 
 NAME = 'System Information'
 LINK = 'status_page'
 
+COLLECT_INTERVAL = 60   # Seconds between samples of memory, network, uptime and temperature
+PROBE_INTERVAL = 3600   # Seconds between I2C bus scans
+PROBE_TIMEOUT = 10      # Seconds before an I2C bus scan is killed
+
+plugin_log = PluginLog(NAME)
+
+
+################################################################################
+# Main function loop:                                                          #
+################################################################################
+class InfoCollector(Thread):
+    """Samples the system information in the background, so pages never wait for it."""
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._stop_event = Event()
+
+        self.snapshot = OrderedDict()
+        self.sample_time = None
+        self.probe_time = None
+        self._i2c = 'Unknown'
+        self._static = None
+        self._mac = None
+
+        self._sleeper = scheduler.register(NAME)
+        self._metrics = LoopMetrics(metrics, NAME)
+        self.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._sleeper.wake()
+
+    def update(self):
+        self._sleeper.wake()
+
+    def _sleep(self, secs):
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
+
+    def _collect(self):
+        if self._static is None:
+            import platform  # Only loaded when the plugin is started
+            self._static = OrderedDict([
+                ('System release', platform.release()),
+                ('System name', platform.system()),
+                ('Node', platform.node()),
+                ('Machine', platform.machine())
+            ])
+            self._mac = helpers.get_mac()
+
+        meminfo = helpers.get_meminfo()
+        netdevs = helpers.get_netdevs()
+        snapshot = OrderedDict(self._static)
+        snapshot['Total memory'] = meminfo['MemTotal']
+        snapshot['Free memory'] = meminfo['MemFree']
+        snapshot['Network'] = OrderedDict((dev, '%s MiB %s MiB' % (info['rx'], info['tx']))
+                                          for dev, info in netdevs.items()) if netdevs else 'Unknown'
+        snapshot['Uptime'] = helpers.uptime()
+        snapshot['CPU temp'] = helpers.get_cpu_temp(options.temp_unit) + ' ' + options.temp_unit
+        snapshot['MAC adress'] = self._mac
+        snapshot['I2C HEX Adress'] = self._i2c
+        self.snapshot = snapshot
+        self.sample_time = time.time()
+
+    def _probe(self):
+        rev = str(0 if helpers.get_rpi_revision() == 1 else 1)
+        self._i2c = process(['sudo', 'i2cdetect', '-y', rev], PROBE_TIMEOUT)
+        self.probe_time = time.time()
+
+    def run(self):
+        next_probe = 0
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                # The I2C bus scan is slow, so it is done less often and after the other information is available:
+                probe_failed = False
+                if self.sample_time is not None and time.monotonic() >= next_probe:
+                    next_probe = time.monotonic() + PROBE_INTERVAL
+                    try:
+                        self._probe()
+                    except Exception:
+                        self._i2c = 'Unknown'
+                        probe_failed = True
+                        plugin_log.error('I2C bus scan failed:\n%s', traceback.format_exc())
+
+                self._collect()
+                if probe_failed:
+                    self._metrics.failure(start)
+                else:
+                    self._metrics.success(start)
+            except Exception:
+                self._metrics.failure(start)
+                plugin_log.error('System info plug-in:\n%s', traceback.format_exc())
+
+            # The first scan follows the first sample right away:
+            self._sleep(0 if self.sample_time is not None and not next_probe else COLLECT_INTERVAL)
+
+        self._sleeper.close()
+
+
+collector = None
+
 
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
 def start():
-    pass
+    global collector
+    if collector is None:
+        collector = InfoCollector()
 
 
-stop = start
+def stop():
+    global collector
+    if collector is not None:
+        collector.stop()
+        collector.join()
+        collector = None
+
 
 def get_overview():
-    """Returns the info data as a list of lines."""
+    """Returns the info data of the last sample as a list of lines."""
     result = []
-    log.clear(NAME)
-    meminfo = helpers.get_meminfo()
-    netdevs = helpers.get_netdevs()
-
-    result.append('System release: ' + platform.release())
-    result.append('System name:    ' + platform.system())
-    result.append('Node:           ' + platform.node())
-    result.append('Machine:        ' + platform.machine())
-    result.append('Total memory:   ' + meminfo['MemTotal'])
-    result.append('Free memory:    ' + meminfo['MemFree'])
-    if netdevs:
-        for dev, info in netdevs.items():
-            result.append('%-16s %s MiB %s MiB' % (dev + ':', info['rx'], info['tx']))
-    else:
-        result.append('Network:        Unknown')
-    result.append('Uptime:         ' + helpers.uptime())
-    result.append('CPU temp:       ' + helpers.get_cpu_temp(options.temp_unit) + ' ' + options.temp_unit)
-    result.append('MAC adress: ' + helpers.get_mac())
-    try:
-        result.append('I2C HEX Adress:')
-        rev = str(0 if helpers.get_rpi_revision() == 1 else 1)
-        cmd = 'sudo i2cdetect -y ' + rev
-        result.append(process(cmd))
-    except Exception:
-        log.error(NAME, 'System info plug-in:\n' + traceback.format_exc())
-    log.info(NAME, result)
+    if collector is None or collector.sample_time is None:
+        return ['No information collected yet.']
+
+    for key, value in collector.snapshot.items():
+        if key == 'Network' and isinstance(value, dict):
+            for dev, info in value.items():
+                result.append('%-16s %s' % (dev + ':', info))
+        elif key == 'I2C HEX Adress':
+            result.append(key + ':')
+            result.append(value)
+        else:
+            result.append('%-16s%s' % (key + ':', value))
+    result.append('Sample age:     %d seconds' % (time.time() - collector.sample_time))
     return result
 
 
-def process(cmd):
-    """process in system"""
+def process(cmd, timeout):
+    """Runs cmd (a list of arguments) and returns its output, killing it after timeout seconds.
+
+    The command gets its own process group, so a timeout also kills the
+    processes it started (like i2cdetect started by sudo). When OSPy does not
+    run as root, a command of sudo cannot be killed; it is then left running
+    after another timeout instead of blocking the caller.
+    """
+    import signal
+    import subprocess
     proc = subprocess.Popen(
         cmd,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        shell=True)
-    output = proc.communicate()[0]
+        start_new_session=True)
+    try:
+        output = proc.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:  # Like PermissionError for the process group of sudo
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        try:
+            proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.stdout.close()
+        raise
     return output.decode('utf-8')
+
+
 ################################################################################
 # Web pages:                                                                   #
 ################################################################################
@@ -73,3 +200,17 @@ class status_page(ProtectedPage):
 
     def GET(self):
         return self.plugin_render.system_info(get_overview())
+
+
+class status_json(ProtectedPage):
+    """Returns the last sample of the system information in JSON format."""
+
+    def GET(self):
+        web.header('Access-Control-Allow-Origin', '*')
+        web.header('Content-Type', 'application/json')
+        if collector is None or collector.sample_time is None:
+            return json.dumps({'age': None})
+        result = OrderedDict(collector.snapshot)
+        result['age'] = round(time.time() - collector.sample_time, 1)
+        result['I2C age'] = None if collector.probe_time is None else round(time.time() - collector.probe_time, 1)
+        return json.dumps(result)
@@ -1,29 +1,42 @@
 # !/usr/bin/env python
 # this plugins check sha on github and update ospy file from github
 
-from threading import Thread, Event, Condition
-import time
-import subprocess
+from threading import Thread, Event, Condition, Lock
+import datetime
 import sys
+import time
 import traceback
 
 import web
 from ospy.webpages import ProtectedPage
 from ospy.helpers import restart
 from ospy.log import log
-from plugins import PluginOptions, plugin_url
+from ospy.scheduler import predicted_schedule
+from plugins import plugin_url
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.options import ManagedPluginOptions, flush_options
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
+from plugins.system_update.git_probe import GitProbe
+from plugins.system_update.staged_update import StagedUpdate, UpdateError
 from ospy import version
 
 
 NAME = 'System Update'
 LINK = 'status_page'
 
-plugin_options = PluginOptions(
+plugin_options = ManagedPluginOptions(
     NAME,
     {
         'auto_update': False,
     }
 )
+plugin_log = PluginLog(NAME)
+
+FETCH_INTERVAL = 3600   # Seconds between fetches from the remote repository
+REFRESH_FETCH_AGE = 300  # Seconds a fetch stays recent enough for a refresh of the status
+UPDATE_DURATION = 300   # Seconds to keep free of runs for installing an update and restarting
+PLAN_HORIZON = 48       # Hours of the program schedule searched for an idle window
 
 
 class StatusChecker(Thread):
@@ -33,96 +46,165 @@ class StatusChecker(Thread):
         self.started = Event()
         self._done = Condition()
         self._stop_event = Event()
+        self._fetch_now = Event()
 
         self.status = {
             'ver_str': version.ver_str,
             'ver_date': version.ver_date,
             'remote': 'None!',
             'remote_branch': 'origin/master',
-            'can_update': False}
-
-        self._sleep_time = 0
+            'can_update': False,
+            'staged': False,
+            'stage_error': None,
+            'planned_update': None}
+
+        self._probe = GitProbe()
+        self._stager = StagedUpdate(self._probe)
+        self._update_lock = Lock()
+        self._sleeper = scheduler.register(NAME)
+        self._metrics = LoopMetrics(metrics, NAME)
+        self._probe_time = metrics.histogram('ospy_git_probe_seconds', 'Duration of a check for a new revision.')
         self.start()
 
     def stop(self):
         self._stop_event.set()
+        self._sleeper.wake()
 
     def update_wait(self):
+        """Checks for a new revision right away, fetching first unless the last fetch is recent."""
+        self._fetch_now.set()
         self._done.acquire()
-        self._sleep_time = 0
+        self._sleeper.wake()
         self._done.wait(10)
         self._done.release()
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0 and not self._stop_event.is_set():
-            time.sleep(1)
-            self._sleep_time -= 1
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
 
     def _update_rev_data(self):
         """Returns the update revision data."""
 
-        command = 'git remote update'
-        subprocess.check_output(command.split())
+        fetch_age = self._probe.fetch_age()
+        max_age = REFRESH_FETCH_AGE if self._fetch_now.is_set() else FETCH_INTERVAL - 60
+        self._fetch_now.clear()
+        if fetch_age is None or fetch_age >= max_age:
+            self._probe.fetch()
 
-        command = 'git config --get remote.origin.url'
-        remote = subprocess.check_output(command.split()).decode('utf-8').strip()
+        remote = self._probe.remote_url()
         if remote:
             self.status['remote'] = remote
 
-        command = 'git rev-parse --abbrev-ref --symbolic-full-name @{u}'
-        remote_branch = subprocess.check_output(command.split()).decode('utf-8').strip()
+        remote_branch = self._probe.upstream()
         if remote_branch:
             self.status['remote_branch'] = remote_branch
 
-        command = 'git log -1 %s --format=%%cd --date=short' % remote_branch
-        new_date = subprocess.check_output(command.split()).decode('utf-8').strip()
-
-        command = 'git rev-list %s --count --first-parent' % remote_branch
-        new_revision = int(subprocess.check_output(command.split()).decode('utf-8'))
-
-        command = 'git log HEAD..%s --oneline' % remote_branch
-        changes = '  ' + '\n  '.join(subprocess.check_output(command.split()).decode('utf-8').split('\n'))
+        new_revision, new_date, changes = self._probe.remote_revision(remote_branch)
 
         if new_revision == version.revision and new_date == version.ver_date:
-            log.info(NAME, 'Up-to-date.')
+            plugin_log.info('Up-to-date.')
             self.status['can_update'] = False
         elif new_revision > version.revision:
-            log.info(NAME, 'New version is available!')
-            log.info(NAME, 'Currently running revision: %d (%s)' % (version.revision, version.ver_date))
-            log.info(NAME, 'Available revision: %d (%s)' % (new_revision, new_date))
-            log.info(NAME, 'Changes:\n' + changes)
+            plugin_log.info('New version is available!')
+            plugin_log.info('Currently running revision: %d (%s)', version.revision, version.ver_date)
+            plugin_log.info('Available revision: %d (%s)', new_revision, new_date)
+            plugin_log.info('Changes:\n%s', changes)
             self.status['can_update'] = True
         else:
-            log.info(NAME, 'Running unknown version!')
-            log.info(NAME, 'Currently running revision: %d (%s)' % (version.revision, version.ver_date))
-            log.info(NAME, 'Available revision: %d (%s)' % (new_revision, new_date))
+            plugin_log.info('Running unknown version!')
+            plugin_log.info('Currently running revision: %d (%s)', version.revision, version.ver_date)
+            plugin_log.info('Available revision: %d (%s)', new_revision, new_date)
             self.status['can_update'] = False
 
         self._done.acquire()
         self._done.notify_all()
         self._done.release()
 
+    def _remote_head(self):
+        return self._probe.resolve('refs/remotes/' + self.status['remote_branch'])
+
+    def stage_update(self):
+        """Prepares the available update in the background, so applying it only takes a restart.
+
+        A revision that cannot be staged is only reported, it is tried again
+        when the remote branch moves on.
+        """
+        with self._update_lock:
+            self.status['staged'] = False
+            try:
+                self._stager.stage(self._remote_head())
+            except UpdateError as err:
+                self.status['stage_error'] = str(err)
+                plugin_log.warning('The new version cannot be installed:\n%s', err)
+                return
+            self.status['stage_error'] = None
+            self.status['staged'] = True
+            plugin_log.info('The update is ready to be installed.')
+
+    def apply_update(self):
+        """Swaps in the staged update. Returns False if it is still being prepared."""
+        if not self._update_lock.acquire(False):
+            return False
+        try:
+            if not self._stager.is_staged(self._remote_head()):
+                self._sleeper.wake()  # Let the loop prepare it
+                return False
+            changed = self._stager.apply()
+            self.status['staged'] = False
+            self.status['can_update'] = False
+            try:
+                self._stager.cleanup()  # The live tree has the update now
+            except Exception:
+                plugin_log.warning('Could not remove the staged update:\n%s', traceback.format_exc())
+        finally:
+            self._update_lock.release()
+        plugin_log.info('Installed the update, %d files changed.', changed)
+        return True
+
     def run(self):
+        try:
+            if self._stager.recover():
+                plugin_log.warning('Undid an update that was interrupted.')
+        except Exception:
+            plugin_log.error('Could not undo an interrupted update:\n%s', traceback.format_exc())
+
         while not self._stop_event.is_set():
+            start = time.monotonic()
             try:
-                log.clear(NAME)
-                self._update_rev_data()
-
-                if self.status['can_update'] and plugin_options['auto_update'] and not log.active_runs():
-                    perform_update()
+                plugin_log.clear()
+                try:
+                    self._update_rev_data()
+                finally:
+                    self._probe_time.observe_since(start)
+
+                planned = None
+                if self.status['can_update']:
+                    self.stage_update()
+                    if plugin_options['auto_update'] and self.status['staged']:
+                        now = datetime.datetime.now()
+                        planned = next_idle_window(now)
+                        if planned is not None and planned <= now:
+                            perform_update()
+                self.status['planned_update'] = planned
 
                 self.started.set()
-                self._sleep(3600)
+                self._metrics.success(start)
+                if planned is not None:  # Wake up right when the idle window starts
+                    self._sleep(min(3600, max(1, (planned - datetime.datetime.now()).total_seconds())))
+                else:
+                    self._sleep(3600)
 
             except Exception:
+                self._metrics.failure(start)
                 self.started.set()
-                log.error(NAME, 'System update plug-in:\n' + traceback.format_exc())
+                plugin_log.error('System update plug-in:\n%s', traceback.format_exc())
                 self._sleep(60)
 
+        self._sleeper.close()
+
 
 checker = None
 
@@ -130,25 +212,45 @@ checker = None
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
-def perform_update():
-    # ignore local chmod permission
-    command = "git config core.filemode false"  # http://superuser.com/questions/204757/git-chmod-problem-checkout-screws-exec-bit
-    subprocess.check_output(command.split())
+def next_idle_window(now, duration=UPDATE_DURATION, horizon=PLAN_HORIZON):
+    """Returns the first time from now on at which no station runs for duration seconds.
+
+    Active runs and the runs predicted for the next horizon hours are taken
+    into account. Returns None if there is no such window within the horizon.
+    """
+    end = now + datetime.timedelta(hours=horizon)
+    length = datetime.timedelta(seconds=duration)
+    runs = [run for run in log.active_runs() + predicted_schedule(now, end) if not run['blocked']]
+
+    candidate = now
+    for run in sorted(runs, key=lambda run: run['start']):
+        if run['start'] >= candidate + length:
+            break
+        candidate = max(candidate, run['end'])
 
-    command = "git reset --hard"
-    subprocess.check_output(command.split())
+    return candidate if candidate + length <= end else None
 
-    command = "git pull"
-    output = subprocess.check_output(command.split()).decode('utf-8')
+
+def perform_update():
+    """Installs the available update and restarts OSPy. Returns False if the update is still being prepared."""
+    import subprocess
+    if checker is None:
+        raise Exception('The System Update plug-in is not running!')
+
+    # The staged update also ignores local chmod permission changes, see
+    # http://superuser.com/questions/204757/git-chmod-problem-checkout-screws-exec-bit
+    if not checker.apply_update():
+        plugin_log.info('The update is still being prepared, please try again in a minute.')
+        return False
 
     # Go back to master (refactor is old):
-    if checker is not None:
-        if checker.status['remote_branch'] == 'origin/refactor':
-            command = 'git checkout master'
-            subprocess.check_output(command.split())
+    if checker.status['remote_branch'] == 'origin/refactor':
+        command = 'git checkout master'
+        subprocess.check_output(command.split())
 
-    log.debug(NAME, 'Update result: ' + output)
+    flush_options()
     restart(3)
+    return True
 
 
 def start():
@@ -163,6 +265,7 @@ def stop():
         checker.stop()
         checker.join()
         checker = None
+    flush_options()
 
 
 ################################################################################
@@ -173,7 +276,7 @@ class status_page(ProtectedPage):
 
     def GET(self):
         checker.started.wait(10)    # Make sure we are initialized
-        return self.plugin_render.system_update(plugin_options, log.events(NAME), checker.status)
+        return self.plugin_render.system_update(plugin_options, plugin_log.events(), checker.status)
 
     def POST(self):
         plugin_options.web_update(web.input())
@@ -195,7 +298,13 @@ class update_page(ProtectedPage):
     """Update OSPi from github and return text message from comm line."""
 
     def GET(self):
-        perform_update()
+        try:
+            updated = perform_update()
+        except Exception:
+            plugin_log.error('Update failed:\n%s', traceback.format_exc())
+            updated = False
+        if not updated:
+            raise web.seeother(plugin_url(status_page), True)
         return self.core_render.restarting(plugin_url(status_page))
 
 
@@ -203,5 +312,6 @@ class restart_page(ProtectedPage):
     """Restart system."""
 
     def GET(self):
+        flush_options()
         restart(3)
         return self.core_render.restarting(plugin_url(status_page))
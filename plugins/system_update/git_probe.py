@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Reads the revision information of a git repository, mostly without running git.
+
+import datetime
+import os
+import re
+import time
+import zlib
+
+_SECTION_RE = re.compile(r'^\s*\[\s*([^\s\]"]+)(?:\s+"([^"]*)")?\s*\]')
+_OPTION_RE = re.compile(r'^\s*([A-Za-z0-9-]+)\s*=\s*(.*?)\s*$')
+_COMMITTER_RE = re.compile(br'^committer .* (\d+) ([+-])(\d\d)(\d\d)$', re.MULTILINE)
+
+
+class GitProbe(object):
+    """Answers the questions of the System Update plug-in about a git repository.
+
+    References, the configuration and the fetch time are read from the files in
+    the .git directory. git itself only runs for the network fetch (when it is
+    due or asked for), for an unusual upstream branch and for the revision
+    count and change log, which are cached for each combination of local and
+    remote commit.
+    """
+
+    def __init__(self, repo_dir='.'):
+        self.repo_dir = repo_dir
+        self._cache_key = None
+        self._cache = None
+        self._last_fetch = None
+
+    @property
+    def git_dir(self):
+        path = os.path.join(self.repo_dir, '.git')
+        if os.path.isfile(path):  # Worktrees and submodules refer to their git directory
+            with open(path) as fh:
+                path = os.path.join(self.repo_dir, fh.read().split(':', 1)[1].strip())
+        elif not os.path.isdir(path):
+            path = self.repo_dir  # Bare repository
+        return path
+
+    def _git(self, *args):
+        import subprocess  # Only loaded when git has to run
+        return subprocess.check_output(('git',) + args, cwd=self.repo_dir).decode('utf-8')
+
+    def _read(self, *path):
+        try:
+            with open(os.path.join(self.git_dir, *path)) as fh:
+                return fh.read().strip()
+        except IOError:
+            return None
+
+    def config(self):
+        """Returns the repository configuration as a dict of 'section.subsection.key' values."""
+        result = {}
+        section = ''
+        for line in (self._read('config') or '').splitlines():
+            match = _SECTION_RE.match(line)
+            if match:
+                section = match.group(1).lower() + ('.' + match.group(2) if match.group(2) is not None else '')
+                continue
+            match = _OPTION_RE.match(line)
+            if match and not line.lstrip().startswith(('#', ';')):
+                result[section + '.' + match.group(1).lower()] = match.group(2).strip('"')
+        return result
+
+    def resolve(self, ref):
+        """Returns the commit id of a reference like 'HEAD' or 'refs/remotes/origin/master'."""
+        for _ in range(10):  # Follow symbolic references
+            value = self._read(*ref.split('/'))
+            if value is None:
+                return self._packed_refs().get(ref)
+            if not value.startswith('ref:'):
+                return value
+            ref = value[4:].strip()
+        return None
+
+    def _packed_refs(self):
+        result = {}
+        for line in (self._read('packed-refs') or '').splitlines():
+            if line and line[0] not in '#^':
+                sha, ref = line.split(' ', 1)
+                result[ref] = sha
+        return result
+
+    def branch(self):
+        """Returns the name of the checked out branch or None if HEAD is detached."""
+        head = self._read('HEAD') or ''
+        if head.startswith('ref: refs/heads/'):
+            return head[len('ref: refs/heads/'):]
+        return None
+
+    def remote_url(self, remote='origin'):
+        return self.config().get('remote.%s.url' % remote, '')
+
+    def upstream(self):
+        """Returns the upstream branch of the checked out branch, like 'origin/master'.
+
+        The usual case of a branch that tracks a branch of a configured remote
+        is read from the configuration, anything else is left to git.
+        """
+        config = self.config()
+        branch = self.branch()
+        remote = config.get('branch.%s.remote' % branch)
+        merge = config.get('branch.%s.merge' % branch, '')
+        if branch is not None and 'remote.%s.url' % remote in config and merge.startswith('refs/heads/'):
+            return remote + '/' + merge[len('refs/heads/'):]
+        return self._git('rev-parse', '--abbrev-ref', '--symbolic-full-name', '@{u}').strip()
+
+    def fetch_age(self):
+        """Returns the number of seconds since the last fetch or None if unknown."""
+        if self._last_fetch is not None:
+            return time.time() - self._last_fetch
+        try:
+            return time.time() - os.path.getmtime(os.path.join(self.git_dir, 'FETCH_HEAD'))
+        except OSError:
+            return None
+
+    def fetch(self):
+        self._git('remote', 'update')
+        self._last_fetch = time.time()
+
+    def commit_date(self, sha):
+        """Returns the commit date (YYYY-MM-DD in the time zone of the committer)."""
+        try:
+            with open(os.path.join(self.git_dir, 'objects', sha[:2], sha[2:]), 'rb') as fh:
+                data = zlib.decompress(fh.read())
+            match = _COMMITTER_RE.search(data)
+            seconds, sign, hours, minutes = int(match.group(1)), match.group(2), int(match.group(3)), int(match.group(4))
+            offset = (hours * 60 + minutes) * (-60 if sign == b'-' else 60)
+            return (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds + offset)).strftime('%Y-%m-%d')
+        except Exception:
+            # Packed objects are left to git:
+            return self._git('log', '-1', sha, '--format=%cd', '--date=short').strip()
+
+    def remote_revision(self, remote_branch):
+        """Returns (revision number, date, change log) of remote_branch compared to HEAD."""
+        key = (self.resolve('HEAD'), self.resolve('refs/remotes/' + remote_branch))
+        if key[1] is None:
+            key = (key[0], self._git('rev-parse', remote_branch).strip())
+
+        if key != self._cache_key:
+            remote_sha = key[1]
+            revision = int(self._git('rev-list', remote_sha, '--count', '--first-parent'))
+            changes = '  ' + '\n  '.join(self._git('log', 'HEAD..%s' % remote_sha, '--oneline').split('\n'))
+            self._cache = (revision, self.commit_date(remote_sha), changes)
+            self._cache_key = key
+        return self._cache
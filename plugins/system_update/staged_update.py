@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# Prepares an update of a git working tree next to it and swaps it in with file renames.
+
+import json
+import os
+import shutil
+import sys
+
+STAGING_DIR = 'ospy-staging'    # Worktree for the new revision, inside the git directory
+BACKUP_DIR = 'ospy-backup'      # Files replaced by the last update, inside the git directory
+JOURNAL = 'ospy-update.journal'  # Renames of an update that is being applied, inside the git directory
+NEW_SUFFIX = '.ospy-new'
+IMPORT_CHECK = ['ospy']         # Modules that must import from the new tree
+
+
+class UpdateError(Exception):
+    pass
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst, follow_symlinks=False)
+    except OSError:
+        shutil.copy2(src, dst, follow_symlinks=False)
+
+
+class StagedUpdate(object):
+    """Updates a git working tree with as little downtime as possible.
+
+    stage() checks the new revision out into a separate worktree, compiles the
+    Python files that changed and checks that the new tree imports. All of
+    that can run in the background while the old version keeps running.
+
+    apply() copies the changed files and their compiled .pyc files next to the
+    live files first (symbolic links are copied as links) and then renames
+    them into place, so every file is replaced atomically and the whole swap
+    only takes a short loop of renames.
+    The copied sources keep the modification time the .pyc files were compiled
+    for, so nothing has to be compiled again after the restart. If the live
+    tree does not import afterwards, the old files are put back.
+
+    Before the first rename, a journal of all renames and their backups is
+    written. It is removed once the new tree imports, so when OSPy stops
+    halfway through an update, recover() puts the old files back on the next
+    start.
+    """
+
+    def __init__(self, probe, python=sys.executable, import_check=None):
+        self._probe = probe
+        self._python = python
+        self._import_check = IMPORT_CHECK if import_check is None else import_check
+        self.staged = None      # Revision that is ready in the staging worktree
+        self.staged_from = None  # Revision of the live tree it was staged for
+        self._failed = None      # ((revision, live revision), error) of the last failed stage()
+
+    @property
+    def repo_dir(self):
+        return os.path.abspath(self._probe.repo_dir)
+
+    @property
+    def staging_dir(self):
+        return os.path.join(os.path.abspath(self._probe.git_dir), STAGING_DIR)
+
+    @property
+    def backup_dir(self):
+        return os.path.join(os.path.abspath(self._probe.git_dir), BACKUP_DIR)
+
+    @property
+    def journal_path(self):
+        return os.path.join(os.path.abspath(self._probe.git_dir), JOURNAL)
+
+    def is_staged(self, revision):
+        """Returns whether revision is ready to be applied to the current tree."""
+        return self.staged == revision and self.staged_from == self._probe.resolve('HEAD')
+
+    def _git(self, *args, **kwargs):
+        import subprocess
+        try:
+            return subprocess.check_output(('git',) + args, stderr=subprocess.STDOUT,
+                                           cwd=kwargs.get('cwd', self.repo_dir)).decode('utf-8')
+        except subprocess.CalledProcessError as err:
+            raise UpdateError('git %s failed:\n%s' % (' '.join(args), err.output.decode('utf-8', 'replace')))
+
+    def _check_imports(self, tree):
+        import subprocess
+        if not self._import_check:
+            return
+        code = ';'.join('import ' + module for module in self._import_check)
+        proc = subprocess.Popen([self._python, '-c', code], cwd=tree, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise UpdateError('The new version does not import:\n' + output.decode('utf-8', 'replace'))
+
+    def stage(self, revision):
+        """Checks revision out into the staging worktree, compiles it and checks that it imports."""
+        current = self._probe.resolve('HEAD')
+        if self.staged == revision and self.staged_from == current and os.path.isdir(self.staging_dir):
+            return
+        if self._failed is not None and self._failed[0] == (revision, current):
+            raise UpdateError(self._failed[1])  # Do not check out and compile a broken revision again
+        self.staged = None
+        try:
+            self._stage(current, revision)
+        except UpdateError as err:
+            self._failed = ((revision, current), str(err))
+            raise
+        self.staged = revision
+        self.staged_from = current
+
+    def _stage(self, current, revision):
+        import py_compile
+        self._git('worktree', 'prune')
+        if os.path.isdir(self.staging_dir):
+            self._git('checkout', '-q', '--detach', '--force', revision, cwd=self.staging_dir)
+            self._git('clean', '-q', '-f', '-d', cwd=self.staging_dir)
+        else:
+            self._git('worktree', 'add', '-q', '--detach', self.staging_dir, revision)
+
+        # Only the changed files are copied with their .pyc, other files cannot block the update:
+        for status, path in self._changes(current, revision):
+            staged = os.path.join(self.staging_dir, path)
+            if status != 'D' and path.endswith('.py') and os.path.isfile(staged):
+                try:
+                    py_compile.compile(staged, doraise=True)
+                except py_compile.PyCompileError as err:
+                    raise UpdateError('The new version does not compile:\n' + err.msg)
+        self._check_imports(self.staging_dir)
+
+    def _changes(self, old, new):
+        """Returns the (status, path) of every file that differs between two revisions."""
+        fields = self._git('diff', '--no-renames', '--name-status', '-z', old, new).split('\0')
+        return [(fields[index], fields[index + 1]) for index in range(0, len(fields) - 1, 2)]
+
+    @staticmethod
+    def _pyc(path):
+        import importlib.util
+        return importlib.util.cache_from_source(path) if path.endswith('.py') else None
+
+    def apply(self):
+        """Swaps the staged revision into the live tree. Returns the number of changed files."""
+        old = self._probe.resolve('HEAD')
+        new = self.staged
+        if new is None or self.staged_from != old:
+            raise UpdateError('No update is staged for the current revision.')
+
+        self._git('config', 'core.filemode', 'false')
+        changes = self._changes(old, new)
+
+        # Everything that can be slow is done first, next to the live files:
+        journal = {'old': old, 'new': new, 'replace': [], 'remove': []}
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+        try:
+            for status, path in changes:
+                live = os.path.join(self.repo_dir, path)
+                pairs = [(os.path.join(self.staging_dir, path), live)]
+                if self._pyc(path) is not None:
+                    pairs.append((self._pyc(os.path.join(self.staging_dir, path)), self._pyc(live)))
+                for staged, target in pairs:
+                    if status == 'D':
+                        if os.path.lexists(target):
+                            journal['remove'].append([target, self._backup(target)])
+                    elif os.path.lexists(staged):
+                        if not os.path.isdir(os.path.dirname(target)):
+                            os.makedirs(os.path.dirname(target))
+                        shutil.copy2(staged, target + NEW_SUFFIX, follow_symlinks=False)
+                        journal['replace'].append([target + NEW_SUFFIX, target, self._backup(target)])
+            self._write_journal(journal)
+        except Exception:
+            for new_file, _, _ in journal['replace']:
+                if os.path.lexists(new_file):
+                    os.remove(new_file)
+            raise
+
+        try:
+            for new_file, target, _ in journal['replace']:
+                os.replace(new_file, target)
+            for target, _ in journal['remove']:
+                if os.path.lexists(target):
+                    os.remove(target)
+
+            self._git('reset', '-q', '--mixed', new)
+            self._git('reset', '-q', '--hard')  # Drops local changes like a pull after a hard reset did
+            self._check_imports(self.repo_dir)
+        except Exception:
+            self._undo(journal)
+            raise
+
+        os.remove(self.journal_path)
+        self.staged = None
+        return len(changes)
+
+    def _backup(self, target):
+        if not os.path.lexists(target):
+            return None
+        backup = os.path.join(self.backup_dir, os.path.relpath(target, self.repo_dir))
+        if not os.path.isdir(os.path.dirname(backup)):
+            os.makedirs(os.path.dirname(backup))
+        _link_or_copy(target, backup)
+        return backup
+
+    def _write_journal(self, journal):
+        with open(self.journal_path + '.tmp', 'w') as fh:
+            json.dump(journal, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+
+    def _undo(self, journal):
+        """Puts the files of the journal back. Can run again if it was interrupted."""
+        for new_file, target, backup in reversed(journal['replace']):
+            if backup is None:
+                if os.path.lexists(target):
+                    os.remove(target)  # Added by the update
+            elif os.path.lexists(backup):
+                os.replace(backup, target)
+            if os.path.lexists(new_file):
+                os.remove(new_file)
+        for target, backup in journal['remove']:
+            if backup is not None and os.path.lexists(backup):
+                os.replace(backup, target)
+        self._git('reset', '-q', '--mixed', journal['old'])
+        os.remove(self.journal_path)
+
+    def recover(self):
+        """Undoes an update that was interrupted while it was applied. Returns True if there was one."""
+        if not os.path.exists(self.journal_path):
+            return False
+        with open(self.journal_path) as fh:
+            journal = json.load(fh)
+        self._undo(journal)
+        self.staged = None
+        return True
+
+    def cleanup(self):
+        """Removes the staging worktree."""
+        if os.path.isdir(self.staging_dir):
+            self._git('worktree', 'remove', '--force', self.staging_dir)
+        self.staged = None
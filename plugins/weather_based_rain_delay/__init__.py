@@ -1,27 +1,108 @@
 # !/usr/bin/env python
 
+from collections import deque
 from threading import Thread, Event
 import traceback
 import json
-import time
 import datetime
+import time
 import web
 from ospy.helpers import stop_onrain
-from ospy.log import log
 from ospy.options import options, rain_blocks
 from ospy.webpages import ProtectedPage
 from ospy.weather import weather
-from plugins import PluginOptions, plugin_url
+from plugins import plugin_url
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.options import ManagedPluginOptions, flush_options
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
+from plugins.core_services.weather_store import weather_store, hour_number, hourly_record
 
 NAME = 'Weather-based Rain Delay'
 LINK = 'settings_page'
 
-plugin_options = PluginOptions(
+plugin_options = ManagedPluginOptions(
     NAME,
     {
         'enabled': False,
         'delay_duration': 24
     })
+plugin_log = PluginLog(NAME)
+
+PAST_HOURS = 3        # Finished hours in the precipitation window
+FORECAST_HOURS = 3    # Forecast hours in the precipitation window, after the current hour
+RAIN_RATE = 0.75      # mm/h above which a rain delay is issued
+DRY_RATE = 0.1        # mm/h below which the rain delay is removed
+
+
+class PrecipitationWindow(object):
+    """Keeps the hourly precipitation around the current hour.
+
+    Finished hours do not change anymore, so they are kept in a deque with a
+    running sum: every new hour costs one append and one popleft. Only the
+    current hour and the few forecast hours are read again on every update.
+    Finished hours are read from and written to the weather store, so the
+    window is filled without fetching after a restart.
+    """
+
+    def __init__(self, past_hours=PAST_HOURS, forecast_hours=FORECAST_HOURS):
+        self.past_hours = past_hours
+        self.forecast_hours = forecast_hours
+        self._past = deque()  # (hour, mm) of finished hours, oldest first
+        self._past_sum = 0.0
+
+    @staticmethod
+    def _record(hour, days):
+        """Returns the record of the hour that starts at hour, matched on the time of each hourly value."""
+        if hour.date() not in days:
+            hourly = {}
+            for value in weather.get_hourly_data(hour.date()):
+                if 'time' in value:
+                    start = datetime.datetime.fromtimestamp(value['time']).replace(minute=0, second=0, microsecond=0)
+                    hourly[start] = value
+            days[hour.date()] = hourly
+        value = days[hour.date()].get(hour)
+        return hourly_record(value) if value is not None else None
+
+    def _precipitation(self, hour, days):
+        record = self._record(hour, days)
+        return record[3] if record is not None else 0.0
+
+    def rates(self, now, current=None):
+        """Returns the mean precipitation (mm/h) from now on and of the whole window around now.
+
+        The current sample, if given, replaces the hourly value of the current hour when it is higher.
+        """
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        first = hour - datetime.timedelta(hours=self.past_hours)
+        days = {}
+
+        if self._past and self._past[-1][0] >= hour:  # The clock went back
+            self._past.clear()
+        while self._past and self._past[0][0] < first:
+            self._past_sum -= self._past.popleft()[1]
+        if not self._past:
+            self._past_sum = 0.0
+
+        next_hour = self._past[-1][0] + datetime.timedelta(hours=1) if self._past else first
+        missing = (hour_number(hour) - hour_number(next_hour))
+        stored = weather_store.get(hour_number(next_hour), missing) if missing > 0 else []
+        for record in stored:
+            if record is None:
+                record = self._record(next_hour, days)
+                if record is not None:
+                    weather_store.put(hour_number(next_hour), [record])
+            value = record[3] if record is not None else 0.0
+            self._past.append((next_hour, value))
+            self._past_sum += value
+            next_hour += datetime.timedelta(hours=1)
+
+        upcoming = [self._precipitation(hour + datetime.timedelta(hours=offset), days)
+                    for offset in range(self.forecast_hours + 1)]
+        if current is not None:
+            upcoming[0] = max(upcoming[0], current)
+        return sum(upcoming) / len(upcoming), (self._past_sum + sum(upcoming)) / (len(self._past) + len(upcoming))
+
 
 ################################################################################
 # Main function loop:                                                          #
@@ -32,56 +113,80 @@ class weather_to_delay(Thread):
         self.daemon = True
         self._stop_event = Event()
 
-        self._sleep_time = 0
+        self._sleeper = scheduler.register(NAME)
+        self._window = PrecipitationWindow()
+        self._metrics = LoopMetrics(metrics, NAME)
+        self._weather_fetch = metrics.histogram('ospy_weather_fetch_seconds', 'Duration of a weather data request.',
+                                                plugin=NAME)
         self.start()
 
     def stop(self):
         self._stop_event.set()
+        self._sleeper.wake()
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0 and not self._stop_event.is_set():
-            time.sleep(1)
-            self._sleep_time -= 1
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
 
     def run(self):
+        weather.add_callback(self.update)
         while not self._stop_event.is_set():
+            start = time.monotonic()
             try:
                 if plugin_options['enabled']:  # if Weather-based Rain Delay plug-in is enabled
-                    log.clear(NAME)
-                    log.info(NAME, 'Checking rain status...')
-
-                    current_data = weather.get_current_data()
-
-                    if 'precipitation' in current_data:
-                        if current_data['precipitation'] > 0.75:
-                            log.info(NAME, 'Rain detected. Adding delay of ' + str(plugin_options['delay_duration']))
-                            rain_blocks[NAME] = datetime.datetime.now() + datetime.timedelta(hours=float(plugin_options['delay_duration']))
+                    plugin_log.clear()
+                    plugin_log.info('Checking rain status...')
+
+                    fetch_start = time.monotonic()
+                    current = weather.get_current_data().get('precipitation')
+                    now = datetime.datetime.now()
+                    upcoming, mean = self._window.rates(now, current)
+                    self._weather_fetch.observe_since(fetch_start)
+                    plugin_log.info('Precipitation: %s mm/h now, %.2f mm/h in the next %d hours, '
+                                    '%.2f mm/h from %d hours ago.', '?' if current is None else round(current, 2),
+                                    upcoming, FORECAST_HOURS, mean, PAST_HOURS)
+
+                    # Only rain from now on extends the delay, rain in the past hours only keeps it:
+                    if max(current or 0.0, upcoming) > RAIN_RATE:
+                        hour = now.replace(minute=0, second=0, microsecond=0)
+                        end = hour + datetime.timedelta(hours=float(plugin_options['delay_duration']))
+                        if rain_blocks.get(NAME) != end:
+                            plugin_log.info('Rain detected. Adding delay of %s', plugin_options['delay_duration'])
+                            rain_blocks[NAME] = end
                             stop_onrain()
+                        else:
+                            plugin_log.info('Rain detected. Delay already set.')
 
-                        elif current_data['precipitation'] > 0.1:
-                            log.info(NAME, 'No rain detected. No action.')
+                    elif max(current or 0.0, mean) > DRY_RATE:
+                        plugin_log.info('No rain detected. No action.')
 
-                        else:
-                            log.info(NAME, 'Good weather detected. Removing rain delay.')
-                            if NAME in rain_blocks:
-                                del rain_blocks[NAME]
+                    else:
+                        plugin_log.info('Good weather detected. Removing rain delay.')
+                        if NAME in rain_blocks:
+                            del rain_blocks[NAME]
 
-                    self._sleep(3600)
+                    # Move the window at the start of the next hour, unless new weather data arrives earlier:
+                    self._metrics.success(start)
+                    self._sleep(3600 - now.minute * 60 - now.second + 1)
                 else:
-                    log.clear(NAME)
-                    log.info(NAME, 'Plug-in is disabled.')
+                    plugin_log.clear()
+                    plugin_log.info('Plug-in is disabled.')
                     if NAME in rain_blocks:
                         del rain_blocks[NAME]
+                    self._metrics.success(start)
                     self._sleep(24 * 3600)
 
             except Exception:
-                log.error(NAME, 'Weather-based Rain Delay plug-in:\n' + traceback.format_exc())
+                self._metrics.failure(start)
+                plugin_log.error('Weather-based Rain Delay plug-in:\n%s', traceback.format_exc())
                 self._sleep(3600)
 
+        weather.remove_callback(self.update)
+        self._sleeper.close()
+
 
 checker = None
 
@@ -103,6 +208,7 @@ def stop():
         checker = None
     if NAME in rain_blocks:
         del rain_blocks[NAME]
+    flush_options()
 
 ################################################################################
 # Web pages:                                                                   #
@@ -111,7 +217,7 @@ class settings_page(ProtectedPage):
     """Load an html page for entering Weather-based Rain Delay adjustments"""
 
     def GET(self):
-        return self.plugin_render.weather_based_rain_delay(plugin_options, log.events(NAME))
+        return self.plugin_render.weather_based_rain_delay(plugin_options, plugin_log.events())
 
     def POST(self):
         plugin_options.web_update(web.input())
@@ -2,25 +2,32 @@
 
 
 import datetime
+import os
+from collections import namedtuple
 from threading import Thread, Event
 import traceback
 import json
 import time
 
 import web
-from ospy.log import log
 from ospy.options import options
 from ospy.options import level_adjustments
+from ospy.log import log
 from ospy.webpages import ProtectedPage
 from ospy.runonce import run_once
 from ospy.stations import stations
 from ospy.weather import weather
-from plugins import PluginOptions, plugin_url
+from plugins import plugin_url
+from plugins.core_services.event_log import PluginLog
+from plugins.core_services.options import ManagedPluginOptions, flush_options
+from plugins.core_services.metrics import metrics, LoopMetrics
+from plugins.core_services.scheduler import scheduler
+from plugins.core_services.weather_store import WeatherStore, hour_number, hourly_record
 
 NAME = 'Weather-based Water Level'
 LINK = 'settings_page'
 
-plugin_options = PluginOptions(
+plugin_options = ManagedPluginOptions(
     NAME,
     {
         'enabled': False,
@@ -35,6 +42,100 @@ plugin_options = PluginOptions(
         'protect_months': []
     })
 
+FROST_NAME = NAME + ' (frost)'
+plugin_log = PluginLog(NAME)
+frost_log = PluginLog(FROST_NAME)
+FROST_CHECK_INTERVAL = 3600  # Seconds between checks when the weather is not updated
+PROTECT_INTERVAL = 3600      # Seconds between protection runs while it freezes
+HYSTERESIS = 1.0             # Degrees Celsius above the protect temperature to end the protection
+RUN_ONCE_RETRY = 300         # Seconds to wait while another run-once program is active
+RUN_ONCE_PROGRAM = -1        # Program number OSPy logs the runs of the run-once program with
+
+
+weather_fetch = metrics.histogram('ospy_weather_fetch_seconds', 'Duration of a weather data request.', plugin=NAME)
+
+# Past days with the precipitation scaled to the rain total, so not shared with the other plugins:
+day_store = WeatherStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'weather_days.bin'))
+
+DayTotals = namedtuple('DayTotals', ['hours', 'temperature', 'wind_speed', 'humidity', 'rain_mm'])
+
+
+def _past_day(check_date):
+    """Returns the hourly records of a day in the past, from the weather store if possible.
+
+    Days that are fetched are stored, with the hourly precipitation scaled to the
+    rain total of the day, so a stored day gives the same totals as a fetched one.
+    """
+    records = day_store.day(check_date)
+    if records is None:
+        start = time.monotonic()
+        records = [hourly_record(val) for val in weather.get_hourly_data(check_date)]
+        rain_mm = weather.get_rain(check_date)
+        weather_fetch.observe_since(start)
+        if records:
+            hourly_rain = sum(record[3] for record in records)
+            scale = rain_mm / hourly_rain if hourly_rain > 0 else 0.0
+            records = [record[:3] + (record[3] * scale if scale else rain_mm / len(records),) for record in records]
+        if len(records) == 24:
+            day_store.put(hour_number(check_date), records)
+    return records
+
+
+def _day_totals(check_date):
+    """Reduces the hourly weather data of a single day to its totals."""
+    if check_date < datetime.date.today():
+        records = _past_day(check_date)
+        return DayTotals(len(records),
+                         sum(record[0] for record in records),
+                         sum(record[1] for record in records),
+                         sum(record[2] for record in records),
+                         sum(record[3] for record in records))
+
+    start = time.monotonic()
+    hours = 0
+    temperature = wind_speed = humidity = 0.0
+    for val in weather.get_hourly_data(check_date):
+        hours += 1
+        temperature += val['temperature']
+        wind_speed += val['windSpeed']
+        humidity += val['humidity']
+    rain_mm = weather.get_rain(check_date)
+    weather_fetch.observe_since(start)
+    return DayTotals(hours, temperature, wind_speed, humidity, rain_mm)
+
+
+class WeatherWindow(object):
+    """Keeps the totals of each day in the history/forecast window around today.
+
+    Days in the past do not change anymore, so they are only reduced once and
+    their hourly data is kept in the weather store across restarts. Today and
+    the forecast days are fetched again on every call. When the date rolls
+    over, the days that were fetched before they were past are fetched once
+    more.
+    """
+
+    def __init__(self):
+        self._days = {}
+        self._today = None
+
+    def totals(self, days_history, days_forecast):
+        """Returns the DayTotals of all days in the window."""
+        today = datetime.date.today()
+        if self._today is not None and today != self._today:
+            for check_date in [check_date for check_date in self._days if check_date >= self._today]:
+                del self._days[check_date]
+        self._today = today
+        days = {}
+        for day in range(-days_history, days_forecast + 1):
+            check_date = today + datetime.timedelta(days=day)
+            totals = self._days.get(check_date)
+            if totals is None or not totals.hours or check_date >= today:
+                totals = _day_totals(check_date)
+            days[check_date] = totals
+
+        self._days = days  # Days that left the window are dropped
+        return list(days.values())
+
 
 ################################################################################
 # Main function loop:                                                          #
@@ -45,49 +146,44 @@ class WeatherLevelChecker(Thread):
         self.daemon = True
         self._stop_event = Event()
 
-        self._sleep_time = 0
+        self._sleeper = scheduler.register(NAME)
+        self._window = WeatherWindow()
+        self._metrics = LoopMetrics(metrics, NAME)
         self.start()
 
     def stop(self):
         self._stop_event.set()
+        self._sleeper.wake()
 
     def update(self):
-        self._sleep_time = 0
+        self._sleeper.wake()
 
     def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0 and not self._stop_event.is_set():
-            time.sleep(1)
-            self._sleep_time -= 1
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
 
     def run(self):
         weather.add_callback(self.update)
         self._sleep(10)  # Wait for weather callback before starting
         while not self._stop_event.is_set():
+            start = time.monotonic()
             try:
-                log.clear(NAME)
+                plugin_log.clear()
                 if plugin_options['enabled']:
-                    log.debug(NAME, "Checking weather status...")
+                    plugin_log.debug("Checking weather status...")
 
-                    info = []
-                    days = 0
-                    total_info = {'rain_mm': 0.0}
-                    for day in range(-plugin_options['days_history'], plugin_options['days_forecast']+1):
-                        check_date = datetime.date.today() + datetime.timedelta(days=day)
-                        hourly_data = weather.get_hourly_data(check_date)
-                        if hourly_data:
-                            days += 1
-                        info += hourly_data
+                    day_totals = self._window.totals(plugin_options['days_history'], plugin_options['days_forecast'])
+                    days = len([totals for totals in day_totals if totals.hours])
+                    hours = sum(totals.hours for totals in day_totals)
 
-                        total_info['rain_mm'] += weather.get_rain(check_date)
+                    plugin_log.info('Using %d days of information.', days)
 
-                    log.info(NAME, 'Using %d days of information.' % days)
-
-                    total_info.update({
-                        'temp_c': sum([val['temperature'] for val in info]) / len(info),
-                        'wind_ms': sum([val['windSpeed'] for val in info]) / len(info),
-                        'humidity': sum([val['humidity'] for val in info]) / len(info)
-                    })
+                    total_info = {
+                        'rain_mm': sum(totals.rain_mm for totals in day_totals),
+                        'temp_c': sum(totals.temperature for totals in day_totals) / hours,
+                        'wind_ms': sum(totals.wind_speed for totals in day_totals) / hours,
+                        'humidity': sum(totals.humidity for totals in day_totals) / hours
+                    }
 
                     # We assume that the default 100% provides 4mm water per day (normal need)
                     # We calculate what we will need to provide using the mean data of X days around today
@@ -98,58 +194,145 @@ class WeatherLevelChecker(Thread):
                     water_needed *= 1 - (total_info['humidity'] - 50) / 200     # 0 => 125%, 100 => 75%
                     water_needed = round(water_needed, 1)
 
-                    water_left = water_needed - total_info['rain_mm']
-                    water_left = round(max(0, min(100, water_left)), 1)
-
-                    water_adjustment = round((water_left / (4 * days)) * 100, 1)
-
-                    water_adjustment = float(
-                        max(plugin_options['wl_min'], min(plugin_options['wl_max'], water_adjustment)))
+                    water_left, water_adjustment = _water_adjustment(water_needed, total_info['rain_mm'], days)
 
-                    log.info(NAME, 'Water needed (%d days): %.1fmm' % (days, water_needed))
-                    log.info(NAME, 'Total rainfall       : %.1fmm' % total_info['rain_mm'])
-                    log.info(NAME, '_______________________________-')
-                    log.info(NAME, 'Irrigation needed    : %.1fmm' % water_left)
-                    log.info(NAME, 'Weather Adjustment   : %.1f%%' % water_adjustment)
+                    plugin_log.info('Water needed (%d days): %.1fmm', days, water_needed)
+                    plugin_log.info('Total rainfall       : %.1fmm', total_info['rain_mm'])
+                    plugin_log.info('_______________________________-')
+                    plugin_log.info('Irrigation needed    : %.1fmm', water_left)
+                    plugin_log.info('Weather Adjustment   : %.1f%%', water_adjustment)
 
                     level_adjustments[NAME] = water_adjustment / 100
 
-                    if plugin_options['protect_enabled']:
-                        current_data = weather.get_current_data()
-                        temp_local_unit = current_data['temperature'] if options.temp_unit == "C" else 32.0 + 9.0 / 5.0 * current_data['temperature']
-                        log.debug(NAME, 'Temperature: %.1f %s' % (temp_local_unit, options.temp_unit))
-                        month = time.localtime().tm_mon  # Current month.
-                        if temp_local_unit < plugin_options['protect_temp'] and month in plugin_options['protect_months']:
-                            station_seconds = {}
-                            for station in stations.enabled_stations():
-                                if station.index in plugin_options['protect_stations']:
-                                    station_seconds[station.index] = plugin_options['protect_minutes'] * 60
-                                else:
-                                    station_seconds[station.index] = 0
-
-                            for station in stations.enabled_stations():
-                                if run_once.is_active(datetime.datetime.now(), station.index):
-                                    break
-                            else:
-                                log.debug(NAME, 'Protection activated.')
-                                run_once.set(station_seconds)
-
+                    self._metrics.success(start)
                     self._sleep(3600)
 
                 else:
-                    log.clear(NAME)
-                    log.info(NAME, 'Plug-in is disabled.')
+                    plugin_log.clear()
+                    plugin_log.info('Plug-in is disabled.')
                     if NAME in level_adjustments:
                         del level_adjustments[NAME]
+                    self._metrics.success(start)
                     self._sleep(24*3600)
 
             except Exception:
-                log.error(NAME, 'Weather-based water level plug-in:\n' + traceback.format_exc())
+                self._metrics.failure(start)
+                plugin_log.error('Weather-based water level plug-in:\n%s', traceback.format_exc())
                 self._sleep(3600)
         weather.remove_callback(self.update)
+        self._sleeper.close()
+
+
+class FrostMonitor(Thread):
+    """Starts the protected stations when it freezes, checked on every weather update.
+
+    The run-once program is built when the settings or the enabled stations
+    change. Protection starts below the protect temperature and stops only
+    when the temperature is HYSTERESIS degrees above it again, so a
+    temperature around the limit does not toggle it. While it freezes the
+    stations run once every PROTECT_INTERVAL, but never while another
+    run-once program is active.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self._stop_event = Event()
+
+        self.freezing = False
+        self._station_seconds = {}
+        self._enabled = None
+        self._settings = None
+        self._protect_until = 0.0   # Monotonic end of the run-once program we started
+        self._next_protect = 0.0
+
+        self._sleeper = scheduler.register(FROST_NAME)
+        self._metrics = LoopMetrics(metrics, FROST_NAME)
+        self.configure()
+        self.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._sleeper.wake()
+
+    def update(self):
+        self._sleeper.wake()
+
+    @staticmethod
+    def _program(enabled):
+        """Returns the run-once program (seconds per station index) for the enabled station indices."""
+        seconds = plugin_options['protect_minutes'] * 60
+        return dict((index, seconds if index in plugin_options['protect_stations'] else 0) for index in enabled)
+
+    def configure(self):
+        """Rebuilds the run-once program from the settings."""
+        enabled = tuple(station.index for station in stations.enabled_stations())
+        station_seconds = self._program(enabled)
+        settings = (station_seconds, plugin_options['protect_temp'], tuple(plugin_options['protect_months']))
+        if settings != self._settings:  # Saving other settings keeps the protection schedule
+            self._station_seconds = station_seconds
+            self._enabled = enabled
+            self._settings = settings
+            self._next_protect = 0.0
+        self.update()
+
+    def _sleep(self, secs):
+        if not self._stop_event.is_set():
+            self._sleeper.sleep(secs)
+
+    def _check(self):
+        """Returns the number of seconds until the next check is needed."""
+        if not plugin_options['enabled'] or not plugin_options['protect_enabled'] or \
+                time.localtime().tm_mon not in plugin_options['protect_months']:
+            self.freezing = False
+            return FROST_CHECK_INTERVAL
+
+        temperature = weather.get_current_data()['temperature']
+        temp_local_unit = temperature if options.temp_unit == "C" else 32.0 + 9.0 / 5.0 * temperature
+        frost_log.debug('Temperature: %.1f %s', temp_local_unit, options.temp_unit)
+
+        hysteresis = HYSTERESIS if options.temp_unit == "C" else HYSTERESIS * 9.0 / 5.0
+        if temp_local_unit < plugin_options['protect_temp']:
+            self.freezing = True
+        elif temp_local_unit >= plugin_options['protect_temp'] + hysteresis:
+            self.freezing = False
+        if not self.freezing:
+            self._next_protect = 0.0
+            return FROST_CHECK_INTERVAL
+
+        now = time.monotonic()
+        if now >= self._next_protect and now >= self._protect_until:
+            if any(run['program'] == RUN_ONCE_PROGRAM for run in log.active_runs()):
+                frost_log.debug('Protection postponed, a run-once program is active.')
+                return RUN_ONCE_RETRY
+            enabled = tuple(station.index for station in stations.enabled_stations())
+            if enabled != self._enabled:  # Stations were enabled, disabled or added in OSPy
+                self._enabled = enabled
+                self._station_seconds = self._program(enabled)
+            frost_log.debug('Protection activated.')
+            run_once.set(self._station_seconds)
+            self._protect_until = now + sum(self._station_seconds.values())
+            self._next_protect = now + PROTECT_INTERVAL
+        return max(1.0, min(FROST_CHECK_INTERVAL, max(self._next_protect, self._protect_until) - now))
+
+    def run(self):
+        weather.add_callback(self.update)
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                delay = self._check()
+                self._metrics.success(start)
+                self._sleep(delay)
+            except Exception:
+                self._metrics.failure(start)
+                frost_log.error('Frost protection:\n%s', traceback.format_exc())
+                self._sleep(FROST_CHECK_INTERVAL)
+        weather.remove_callback(self.update)
+        self._sleeper.close()
 
 
 checker = None
+frost_monitor = None
 
 
 ################################################################################
@@ -157,19 +340,38 @@ checker = None
 ################################################################################
 
 def start():
-    global checker
+    global checker, frost_monitor
     if checker is None:
         checker = WeatherLevelChecker()
+    if frost_monitor is None:
+        frost_monitor = FrostMonitor()
 
 
 def stop():
-    global checker
+    global checker, frost_monitor
     if checker is not None:
         checker.stop()
         checker.join()
         checker = None
+    if frost_monitor is not None:
+        frost_monitor.stop()
+        frost_monitor.join()
+        frost_monitor = None
     if NAME in level_adjustments:
         del level_adjustments[NAME]
+    flush_options()
+
+
+def _water_adjustment(water_needed, rain_mm, days):
+    """Returns the irrigation needed (mm) and the water level (%) within the configured limits."""
+    water_left = water_needed - rain_mm
+    water_left = round(max(0, min(100, water_left)), 1)
+
+    water_adjustment = round((water_left / (4 * days)) * 100, 1)
+
+    water_adjustment = float(
+        max(plugin_options['wl_min'], min(plugin_options['wl_max'], water_adjustment)))
+    return water_left, water_adjustment
 
 
 ################################################################################
@@ -179,12 +381,14 @@ class settings_page(ProtectedPage):
     """Load an html page for entering weather-based irrigation adjustments"""
 
     def GET(self):
-        return self.plugin_render.weather_based_water_level(plugin_options, log.events(NAME))
+        return self.plugin_render.weather_based_water_level(plugin_options, plugin_log.events() + frost_log.events())
 
     def POST(self):
         plugin_options.web_update(web.input(**plugin_options))
         if checker is not None:
             checker.update()
+        if frost_monitor is not None:
+            frost_monitor.configure()
         raise web.seeother(plugin_url(settings_page), True)
 
 
@@ -195,3 +399,4 @@ class settings_json(ProtectedPage):
         web.header('Access-Control-Allow-Origin', '*')
         web.header('Content-Type', 'application/json')
         return json.dumps(plugin_options)
+
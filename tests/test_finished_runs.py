@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Reports the finished runs in the (stand-in) OSPy run log once.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'stand_in'))
+
+from ospy.log import log
+from plugins.email_notifications import FinishedRuns
+
+
+class FinishedRunsTest(unittest.TestCase):
+    def setUp(self):
+        self.entries = log._log['Run']
+        del self.entries[:]
+
+    def tearDown(self):
+        del self.entries[:]
+
+    def _stations(self, runs):
+        return [run['station'] for run in runs]
+
+    def test_runs_before_start_are_skipped(self):
+        log.add_run(0)
+        finished_runs = FinishedRuns()
+        self.assertEqual(finished_runs.poll(), [])
+        log.add_run(1)
+        self.assertEqual(self._stations(finished_runs.poll()), [1])
+        self.assertEqual(finished_runs.poll(), [])
+
+    def test_active_runs_are_reported_when_finished(self):
+        first = log.add_run(0, active=True)
+        finished_runs = FinishedRuns()
+        second = log.add_run(1, active=True)
+        log.add_run(2)
+        self.assertEqual(self._stations(finished_runs.poll()), [2])
+        second['active'] = False
+        self.assertEqual(self._stations(finished_runs.poll()), [1])
+        first['active'] = False
+        self.assertEqual(self._stations(finished_runs.poll()), [0])
+        self.assertEqual(finished_runs.poll(), [])
+
+    def test_pruned_log(self):
+        for station in range(10):
+            log.add_run(station)
+        finished_runs = FinishedRuns()
+        del self.entries[:4]
+        log.add_run(10)
+        self.assertEqual(self._stations(finished_runs.poll()), [10])
+        del self.entries[:]
+        log.add_run(11)
+        self.assertEqual(self._stations(finished_runs.poll()), [11])
+
+
+if __name__ == '__main__':
+    unittest.main()
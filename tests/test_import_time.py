@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# Keeps every core plug-in within the import budget of benchmarks/import_time.py.
+
+import os
+import subprocess
+import sys
+import unittest
+
+IMPORT_TIME = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'import_time.py')
+
+
+def import_time(*args):
+    proc = subprocess.Popen([sys.executable, IMPORT_TIME, '--check'] + list(args),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = proc.communicate()
+    return proc.returncode, errors.decode('utf-8')
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_within_budget(self):
+        returncode, errors = import_time('--repeat', '3')
+        self.assertEqual(returncode, 0, errors)
+
+    def test_over_budget_fails(self):
+        returncode, errors = import_time('--repeat', '1', '--budget', '0', '--plugin', 'core_services')
+        self.assertNotEqual(returncode, 0)
+        self.assertIn('core_services takes', errors)
+
+
+if __name__ == '__main__':
+    unittest.main()
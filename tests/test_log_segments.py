@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Rotates, pages and searches an event log with compressed segments.
+
+import datetime
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'stand_in'))
+
+from ospy import log
+import plugins.system_debug as system_debug
+from plugins.system_debug import LogIndex
+from plugins.system_debug.log_segments import LogSegments, MEMBER_SIZE, TIME_RE
+
+START = datetime.datetime(2026, 1, 1)
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+def stamp(number):
+    return (START + datetime.timedelta(seconds=number)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def event(number):
+    """Returns message number of the test log, every tenth message continues on a second line."""
+    text = '%s %s Plugin %d: message %d' % (stamp(number), LEVELS[number % 4], number % 3, number)
+    if number % 10 == 9:
+        text += '\n  details of message %d' % number
+    return text
+
+
+def log_text(first, count):
+    return ''.join(event(number) + '\n' for number in range(first, first + count)).encode('utf-8')
+
+
+class LogSegmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'events.log')
+        self.segments = LogSegments(self.path)
+        self.index = LogIndex(self.path, self.segments)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _all_lines(self):
+        return self.index.lines(0, 10 ** 6)
+
+    def test_write_in_blocks(self):
+        text = log_text(0, 10000)
+        self.assertTrue(self.segments.write(io.BytesIO(text)))
+        self.assertFalse(self.segments.write(io.BytesIO(b'')))
+        self.assertEqual(len(self.segments.segments()), 1)
+
+        members = self.segments.segments()[0].members()
+        self.assertGreater(len(members), 2)
+        self.assertTrue(all(member.length < 2 * MEMBER_SIZE for member in members))
+        self.assertEqual(self.segments.end(), (text.count(b'\n'), len(text)))
+        for member in members:  # A message is never split over two blocks
+            first, lines = self.segments.lines_at(member.first_line)
+            self.assertEqual(first, member.first_line)
+            self.assertIsNotNone(TIME_RE.match(lines[0]))
+        self.assertEqual(''.join(line + '\n' for _, line in self._all_lines()).encode('utf-8'), text)
+
+    def test_paging(self):
+        self.segments.write(io.BytesIO(log_text(0, 3000)))
+        with open(self.path, 'wb') as fh:
+            fh.write(log_text(3000, 1000))
+        lines = self._all_lines()
+        total = len(lines)
+        self.assertEqual([number for number, _ in lines], list(range(total)))
+
+        # Back from the newest line, over the border between the segment and the log file:
+        newest = self.index.lines(total - 1, 500, reverse=True)
+        self.assertEqual(newest, lines[-500:])
+        older = self.index.lines(newest[0][0] - 1, 500, reverse=True)
+        self.assertEqual(older, lines[-1000:-500])
+        self.assertEqual(self.index.lines(older[-1][0] + 1, 500), newest)
+
+        errors = self.index.lines(0, 10 ** 6, min_level=3)
+        self.assertTrue(errors)
+        self.assertTrue(all(' ERROR ' in line or line.startswith('  details') for _, line in errors))
+        plugin = self.index.lines(total - 1, 20, plugin='Plugin 2:', reverse=True)
+        self.assertEqual(len(plugin), 20)
+        self.assertTrue(all('Plugin 2:' in line for _, line in plugin))
+
+    def test_find_time(self):
+        self.segments.write(io.BytesIO(log_text(0, 3000)))
+        with open(self.path, 'wb') as fh:
+            fh.write(log_text(3000, 1000))
+        lines = self._all_lines()
+        for number in [0, 1, 1234, 2999, 3000, 3500, 3999]:
+            found = self.index.find_time(stamp(number))
+            self.assertEqual(lines[found][1], event(number).split('\n')[0])
+        self.assertEqual(self.index.find_time('2025-12-31 00:00:00'), 0)
+        self.assertEqual(self.index.find_time('2027-01-01 00:00:00'), len(lines))
+
+    def test_follow_across_segments(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(log_text(0, 100))
+        offset = self.index.follow(0)[0]
+        self.segments.write(io.BytesIO(log_text(0, 100)))
+        os.remove(self.path)
+        with open(self.path, 'wb') as fh:
+            fh.write(log_text(100, 5))
+        self.index.reset()
+        offset, text = self.index.follow(offset)
+        self.assertEqual(text.encode('utf-8'), log_text(100, 5))
+
+
+class RotationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'events.log')
+        self.saved = log.EVENT_FILE, system_debug.event_segments, system_debug.event_index
+        log.EVENT_FILE = self.path
+        system_debug.event_segments = LogSegments(self.path)
+        system_debug.event_index = LogIndex(self.path, system_debug.event_segments)
+        self.logger = logging.getLogger('rotation test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = logging.FileHandler(self.path)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        log.EVENT_FILE, system_debug.event_segments, system_debug.event_index = self.saved
+        shutil.rmtree(self.tmp)
+
+    def _log(self, first, count):
+        for number in range(first, first + count):
+            self.logger.info(event(number))
+
+    def test_rotation_keeps_every_line(self):
+        self._log(0, 5000)
+        self.assertTrue(system_debug.needs_rotation())  # The first line is more than a week old
+        size = os.path.getsize(self.path)
+        self.assertTrue(system_debug.rotate_events())
+        self.assertFalse(os.path.exists(self.path))
+        self._log(5000, 10)  # The handler opens a new file
+        self.assertEqual(os.path.getsize(self.path), len(log_text(5000, 10)))
+
+        lines = system_debug.event_index.lines(0, 10 ** 6)
+        expected = (log_text(0, 5010)).decode('utf-8').split('\n')[:-1]
+        self.assertEqual([line for _, line in lines], expected)
+        self.assertEqual(system_debug.event_index.size(), size + len(log_text(5000, 10)))
+        self.assertEqual(system_debug.event_segments.disk_usage()[0], 1)
+
+    def test_interrupted_rotation_is_finished(self):
+        self._log(0, 100)
+        os.rename(self.path, self.path + system_debug.ROTATING_SUFFIX)
+        self._log(100, 10)  # Written before the handler was closed: the old file is still open
+        self.handler.setStream(None).close()
+        self.assertTrue(system_debug.needs_rotation())
+        self.assertTrue(system_debug.rotate_events())
+        self.assertFalse(os.path.exists(self.path + system_debug.ROTATING_SUFFIX))
+        self.assertEqual(len(system_debug.event_index.lines(0, 10 ** 6)), log_text(0, 110).count(b'\n'))
+
+    def test_not_rotated_without_handler(self):
+        self._log(0, 10)
+        self.logger.removeHandler(self.handler)
+        self.assertFalse(system_debug.rotate_events())
+        self.assertTrue(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Delivers queued mail to a local SMTP stand-in.
+
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'stand_in'))
+
+from plugins.email_notifications import mail_queue
+from plugins.email_notifications.mail_queue import MailQueue
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib, without STARTTLS and AUTH."""
+
+    def _reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self._reply('220 localhost stand-in')
+        for line in self.rfile:
+            command = line.decode('ascii').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self._reply('250 localhost')
+            elif command.startswith('MAIL'):
+                if server.failures > 0:
+                    server.failures -= 1
+                    self._reply('451 Try again later')
+                else:
+                    self._reply('250 OK')
+            elif command.startswith(('RCPT', 'RSET', 'NOOP')):
+                self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b'.') else data_line)
+                server.messages.append(b''.join(lines))
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                break
+            else:
+                self._reply('502 Not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.failures = 0
+        self.messages = []
+
+
+class MailQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.spool = os.path.join(self.tmp, 'spool')
+        self.server = SMTPStandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.retry_delay = mail_queue.RETRY_DELAY
+        mail_queue.RETRY_DELAY = 0.05
+        self.results = []
+        self.retries = []
+        self.done = threading.Event()
+        self.retried = threading.Event()
+        self.queue = None
+
+    def tearDown(self):
+        if self.queue is not None:
+            self.queue.stop()
+            self.queue.join(5)
+        mail_queue.RETRY_DELAY = self.retry_delay
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _start(self, expected=1):
+        def on_result(mail_id, error):
+            self.results.append((mail_id, error))
+            if len(self.results) >= expected:
+                self.done.set()
+
+        self.queue = MailQueue(self.spool, lambda: ('', ''), '127.0.0.1', self.server.server_address[1],
+                               use_tls=False, on_result=on_result,
+                               on_retry=self._on_retry)
+        return self.queue
+
+    def _on_retry(self, *args):
+        self.retries.append(args)
+        self.retried.set()
+
+    def test_deliver(self):
+        queue = self._start()
+        mail_id = queue.put('ospy@example.com', 'user@example.com', 'Subject: Test\n\nFirst line\n.Dotted line\n')
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.results, [(mail_id, None)])
+        self.assertEqual(self.server.messages, [b'Subject: Test\r\n\r\nFirst line\r\n.Dotted line\r\n'])
+        self.assertEqual(queue.pending(), 0)
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_share_connection(self):
+        queue = self._start(2)
+        queue.put('ospy@example.com', 'user@example.com', 'Subject: One\n\n1\n')
+        queue.put('ospy@example.com', 'user@example.com', 'Subject: Two\n\n2\n')
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual([error for _, error in self.results], [None, None])
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retry_failed_attempts(self):
+        self.server.failures = 2
+        queue = self._start()
+        mail_id = queue.put('ospy@example.com', 'user@example.com', 'Subject: Test\n\nText\n')
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.results, [(mail_id, None)])
+        self.assertEqual([args[:3] for args in self.retries], [(mail_id, 1, 0.05), (mail_id, 2, 0.1)])
+        self.assertIn('451', self.retries[0][3])
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_spool_survives_restart(self):
+        self.server.failures = 1
+        mail_queue.RETRY_DELAY = 60
+        queue = self._start()
+        mail_id = queue.put('ospy@example.com', 'user@example.com', 'Subject: Test\n\nText\n')
+        self.assertTrue(self.retried.wait(5))
+        queue.stop()
+        queue.join(5)
+        self.assertEqual(self.results, [])
+
+        queue = self._start()
+        self.assertEqual(queue.pending(), 1)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.results, [(mail_id, None)])
+        self.assertEqual(len(self.server.messages), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# Writes managed plugin options to the (stand-in) OSPy options.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'stand_in'))
+
+from ospy.options import options
+from plugins.core_services.options import ManagedPluginOptions, flush_options, settings_cache
+
+
+class ManagedPluginOptionsTest(unittest.TestCase):
+    def setUp(self):
+        flush_options()
+        self.plugin_options = ManagedPluginOptions('Options test', {'count': 1, 'enabled': False, 'password': ''},
+                                                   secrets=['password'])
+
+    def tearDown(self):
+        flush_options()
+        options.pop('Options test', None)
+
+    def test_change_is_written_later(self):
+        self.plugin_options['count'] = 2
+        self.assertNotEqual(options.get('Options test', {}).get('count'), 2)
+        flush_options()
+        self.assertEqual(options['Options test']['count'], 2)
+
+    def test_web_update_is_written_at_once(self):
+        self.plugin_options.web_update({'count': '5', 'enabled': 'on'})
+        self.assertEqual(options['Options test'], {'count': 5, 'enabled': True, 'password': ''})
+
+    def test_secret_is_written_at_once(self):
+        self.plugin_options['password'] = 'secret'
+        self.assertEqual(options['Options test']['password'], 'secret')
+
+    def test_settings_are_redacted(self):
+        self.plugin_options['password'] = 'secret'
+        etag, body = settings_cache.get()
+        self.assertIn(b'"password": "********"', body)
+        self.assertEqual(settings_cache.get(), (etag, body))
+        self.plugin_options['count'] = 3
+        self.assertNotEqual(settings_cache.get()[0], etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
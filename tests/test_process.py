@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# Runs commands with a timeout like the System Information plug-in does for the I2C scan.
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'stand_in'))
+
+from plugins.system_info import process
+
+
+class ProcessTest(unittest.TestCase):
+    def test_output(self):
+        self.assertEqual(process(['echo', 'scan'], 5), 'scan\n')
+
+    def test_timeout_kills_process_group(self):
+        start = time.monotonic()
+        self.assertRaises(subprocess.TimeoutExpired, process, ['sh', '-c', 'sleep 30 & sleep 30'], 0.2)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_timeout_without_permission_to_kill(self):
+        def refuse(*args):
+            raise PermissionError(1, 'Operation not permitted')
+
+        killpg, kill = os.killpg, subprocess.Popen.kill
+        os.killpg, subprocess.Popen.kill = refuse, refuse
+        try:
+            start = time.monotonic()
+            self.assertRaises(subprocess.TimeoutExpired, process, ['sleep', '2'], 0.2)
+            self.assertLess(time.monotonic() - start, 1.5)
+        finally:
+            os.killpg, subprocess.Popen.kill = killpg, kill
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Probes, stages and applies updates of a clone of a temporary bare repository.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'stand_in'))
+
+from plugins.system_update.git_probe import GitProbe
+from plugins.system_update.staged_update import StagedUpdate, UpdateError
+
+
+def git(cwd, *args):
+    return subprocess.check_output(('git',) + args, cwd=cwd, stderr=subprocess.STDOUT).decode('utf-8').strip()
+
+
+def commit(tree, files, message):
+    for path, text in files.items():
+        if text is None:
+            os.remove(os.path.join(tree, path))
+            continue
+        if not os.path.isdir(os.path.dirname(os.path.join(tree, path))):
+            os.makedirs(os.path.dirname(os.path.join(tree, path)))
+        with open(os.path.join(tree, path), 'w') as fh:
+            fh.write(text)
+    git(tree, 'add', '-A')
+    git(tree, 'commit', '-q', '-m', message)
+    git(tree, 'push', '-q', 'origin', 'HEAD:master')
+    return git(tree, 'rev-parse', 'HEAD')
+
+
+class Crash(BaseException):
+    """Stops apply() like a power failure would, without running its own rollback."""
+
+
+class RepositoryTest(unittest.TestCase):
+    """A live clone of a bare repository, like an OSPy installation, and a clone to push new versions from."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.remote = os.path.join(self.tmp, 'remote.git')
+        self.upstream = os.path.join(self.tmp, 'upstream')
+        self.live = os.path.join(self.tmp, 'live')
+        git(self.tmp, 'init', '-q', '--bare', '-b', 'master', self.remote)
+        git(self.tmp, 'clone', '-q', self.remote, self.upstream)
+        for key, value in [('user.name', 'Test'), ('user.email', 'test@example.com')]:
+            git(self.upstream, 'config', key, value)
+        self.old = commit(self.upstream, {'ospy/__init__.py': 'VERSION = 1\n', 'ospy/gone.py': 'GONE = True\n'},
+                          'Version 1')
+        git(self.tmp, 'clone', '-q', self.remote, self.live)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _new_version(self, init='VERSION = 2\n'):
+        new = commit(self.upstream, {'ospy/__init__.py': init, 'ospy/gone.py': None, 'ospy/added.py': 'ADDED = 1\n'},
+                     'Version 2')
+        git(self.live, 'fetch', '-q')
+        return new
+
+    def _read(self, path):
+        with open(os.path.join(self.live, path)) as fh:
+            return fh.read()
+
+    def _assert_old_tree(self):
+        self.assertEqual(git(self.live, 'rev-parse', 'HEAD'), self.old)
+        self.assertEqual(self._read('ospy/__init__.py'), 'VERSION = 1\n')
+        self.assertTrue(os.path.exists(os.path.join(self.live, 'ospy', 'gone.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.live, 'ospy', 'added.py')))
+        self.assertEqual(git(self.live, 'status', '--porcelain', '--untracked-files=no'), '')
+
+
+class GitProbeTest(RepositoryTest):
+    def _count_git(self, probe):
+        calls = []
+        run_git = probe._git
+
+        def counted(*args):
+            calls.append(args)
+            return run_git(*args)
+        probe._git = counted
+        return calls
+
+    def test_upstream(self):
+        probe = GitProbe(self.live)
+        self.assertEqual(probe.upstream(), 'origin/master')
+        git(self.live, 'checkout', '-q', '-b', 'local', '--track', 'master')  # Tracks a local branch
+        self.assertEqual(probe.upstream(), 'master')
+
+    def test_remote_revision_is_cached(self):
+        probe = GitProbe(self.live)
+        calls = self._count_git(probe)
+        self.assertEqual(probe.remote_revision('origin/master')[0], 1)
+        self.assertEqual(len(calls), 2)
+        probe.remote_revision('origin/master')
+        self.assertEqual(len(calls), 2)  # Nothing changed, answered from memory
+
+        new = self._new_version()
+        revision, date, changes = probe.remote_revision('origin/master')
+        self.assertEqual(revision, 2)
+        self.assertIn(new[:7], changes)
+        self.assertEqual(len(calls), 4)
+
+        git(self.live, 'merge', '-q', '--ff-only', 'origin/master')  # Only HEAD moves
+        self.assertEqual(probe.remote_revision('origin/master')[2].strip(), '')
+        self.assertEqual(len(calls), 6)
+
+    def test_packed_refs(self):
+        new = self._new_version()
+        git(self.live, 'pack-refs', '--all')
+        self.assertFalse(os.path.exists(os.path.join(self.live, '.git', 'refs', 'remotes', 'origin', 'master')))
+        probe = GitProbe(self.live)
+        calls = self._count_git(probe)
+        self.assertEqual(probe.resolve('refs/remotes/origin/master'), new)
+        self.assertEqual(probe.resolve('HEAD'), self.old)
+        self.assertIsNone(probe.resolve('refs/remotes/origin/missing'))
+        self.assertEqual(calls, [])
+
+    def test_commit_date(self):
+        expected = git(self.live, 'log', '-1', self.old, '--format=%cd', '--date=short')
+        probe = GitProbe(self.live)
+        calls = self._count_git(probe)
+        self.assertEqual(probe.commit_date(self.old), expected)
+        self.assertEqual(calls, [])  # Read from the loose object
+
+        git(self.live, 'gc', '-q')
+        self.assertEqual(probe.commit_date(self.old), expected)
+        self.assertEqual(len(calls), 1)  # Packed objects are left to git
+
+    def test_fetch_age(self):
+        probe = GitProbe(self.live)
+        self.assertIsNone(probe.fetch_age())  # Cloned, never fetched
+        git(self.live, 'fetch', '-q')
+        self.assertLess(probe.fetch_age(), 60)
+        os.utime(os.path.join(self.live, '.git', 'FETCH_HEAD'), (0, 0))
+        self.assertGreater(probe.fetch_age(), 3600)
+        probe.fetch()
+        self.assertLess(probe.fetch_age(), 60)
+
+
+class StagedUpdateTest(RepositoryTest):
+    def test_stage_and_apply(self):
+        new = self._new_version()
+        stager = StagedUpdate(GitProbe(self.live))
+        stager.stage(new)
+        self.assertTrue(stager.is_staged(new))
+        self.assertEqual(self._read('ospy/__init__.py'), 'VERSION = 1\n')  # Staging leaves the live tree alone
+
+        self.assertEqual(stager.apply(), 3)
+        self.assertEqual(git(self.live, 'rev-parse', 'HEAD'), new)
+        self.assertEqual(self._read('ospy/__init__.py'), 'VERSION = 2\n')
+        self.assertFalse(os.path.exists(os.path.join(self.live, 'ospy', 'gone.py')))
+        self.assertTrue(os.path.exists(os.path.join(self.live, 'ospy', 'added.py')))
+        self.assertFalse(os.path.exists(stager.journal_path))
+        stager.cleanup()
+        self.assertFalse(os.path.isdir(stager.staging_dir))
+
+    def test_unchanged_file_does_not_block_update(self):
+        commit(self.upstream, {'tools/broken.py': 'def broken(:\n'}, 'Broken tool')
+        git(self.live, 'pull', '-q')
+        new = self._new_version()
+        stager = StagedUpdate(GitProbe(self.live))
+        stager.stage(new)
+        self.assertEqual(stager.apply(), 3)
+
+        commit(self.upstream, {'ospy/added.py': 'def broken(:\n'}, 'Broken module')
+        git(self.live, 'fetch', '-q')
+        self.assertRaises(UpdateError, stager.stage, git(self.upstream, 'rev-parse', 'HEAD'))
+
+    def test_symlink_is_copied_as_link(self):
+        os.symlink('__init__.py', os.path.join(self.upstream, 'ospy', 'link.py'))
+        new = self._new_version()
+        stager = StagedUpdate(GitProbe(self.live))
+        stager.stage(new)
+        stager.apply()
+        link = os.path.join(self.live, 'ospy', 'link.py')
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(os.readlink(link), '__init__.py')
+        self.assertEqual(git(self.live, 'status', '--porcelain', '--untracked-files=no'), '')
+
+    def test_stage_refuses_revision_that_does_not_import(self):
+        new = self._new_version('raise ImportError("broken")\n')
+        stager = StagedUpdate(GitProbe(self.live))
+        self.assertRaises(UpdateError, stager.stage, new)
+        self.assertRaises(UpdateError, stager.stage, new)  # Remembered, not compiled again
+        self._assert_old_tree()
+
+    def test_rollback_when_live_tree_does_not_import(self):
+        new = self._new_version()
+        stager = StagedUpdate(GitProbe(self.live))
+        stager.stage(new)
+
+        def check_imports(tree):
+            if os.path.abspath(tree) == stager.repo_dir:
+                raise UpdateError('The new version does not import.')
+        stager._check_imports = check_imports
+
+        self.assertRaises(UpdateError, stager.apply)
+        self._assert_old_tree()
+        self.assertFalse(os.path.exists(stager.journal_path))
+
+    def test_recover_interrupted_apply(self):
+        new = self._new_version()
+        stager = StagedUpdate(GitProbe(self.live))
+        stager.stage(new)
+        replace = os.replace
+        calls = []
+
+        def interrupted_replace(src, dst):
+            calls.append(dst)
+            if len(calls) == 3:  # The journal and the first file are in place
+                raise Crash()
+            replace(src, dst)
+        os.replace = interrupted_replace
+        try:
+            self.assertRaises(Crash, stager.apply)
+        finally:
+            os.replace = replace
+        self.assertTrue(os.path.exists(stager.journal_path))
+
+        restarted = StagedUpdate(GitProbe(self.live))
+        self.assertTrue(restarted.recover())
+        self._assert_old_tree()
+        self.assertFalse(restarted.recover())
+
+
+if __name__ == '__main__':
+    unittest.main()